@@ -0,0 +1,299 @@
+import os
+import sqlite3
+from ssbp import SSBP, __version__ as parser_version
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    unit TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    version INTEGER,
+    error TEXT,
+    indexer TEXT
+);
+CREATE TABLE IF NOT EXISTS cell_maps (
+    unit TEXT NOT NULL,
+    name TEXT NOT NULL,
+    image_path TEXT,
+    wrap_mode TEXT,
+    filter_mode TEXT
+);
+CREATE TABLE IF NOT EXISTS cells (
+    unit TEXT NOT NULL,
+    cell_map TEXT NOT NULL,
+    name TEXT NOT NULL,
+    cell_index INTEGER,
+    x INTEGER,
+    y INTEGER,
+    width INTEGER,
+    height INTEGER,
+    pivot_x REAL,
+    pivot_y REAL
+);
+CREATE TABLE IF NOT EXISTS packages (
+    unit TEXT NOT NULL,
+    name TEXT NOT NULL,
+    part_count INTEGER,
+    animation_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS parts (
+    unit TEXT NOT NULL,
+    package TEXT NOT NULL,
+    name TEXT NOT NULL,
+    part_index INTEGER,
+    parent_index INTEGER,
+    type TEXT,
+    bounds_type TEXT,
+    alpha_blend_type TEXT,
+    animation_instance_name TEXT,
+    effect_name TEXT
+);
+CREATE TABLE IF NOT EXISTS animations (
+    unit TEXT NOT NULL,
+    package TEXT NOT NULL,
+    name TEXT NOT NULL,
+    frame_count INTEGER,
+    fps INTEGER,
+    canvas_width INTEGER,
+    canvas_height INTEGER
+);
+CREATE TABLE IF NOT EXISTS labels (
+    unit TEXT NOT NULL,
+    package TEXT NOT NULL,
+    animation TEXT NOT NULL,
+    name TEXT NOT NULL,
+    time INTEGER
+);
+CREATE TABLE IF NOT EXISTS user_data (
+    unit TEXT NOT NULL,
+    package TEXT NOT NULL,
+    animation TEXT NOT NULL,
+    frame INTEGER NOT NULL,
+    part_index INTEGER,
+    integer INTEGER,
+    rect TEXT,
+    point TEXT,
+    string TEXT
+);
+CREATE INDEX IF NOT EXISTS cell_maps_unit ON cell_maps (unit);
+CREATE INDEX IF NOT EXISTS cells_unit ON cells (unit);
+CREATE INDEX IF NOT EXISTS packages_unit ON packages (unit);
+CREATE INDEX IF NOT EXISTS parts_unit ON parts (unit, package);
+CREATE INDEX IF NOT EXISTS animations_unit ON animations (unit, package);
+CREATE INDEX IF NOT EXISTS animations_name ON animations (name);
+CREATE INDEX IF NOT EXISTS labels_unit ON labels (unit, package, animation);
+CREATE INDEX IF NOT EXISTS labels_name ON labels (name);
+CREATE INDEX IF NOT EXISTS user_data_unit ON user_data (unit, package, animation, frame);
+CREATE INDEX IF NOT EXISTS user_data_animation ON user_data (animation, frame);
+"""
+
+# Bumped when the tables or what is stored in them change. Units indexed by another parser or schema version,
+# including the errors of parsers that couldn't read them, are indexed again on the next update
+SCHEMA_VERSION = 2
+INDEXER_VERSION = f'{parser_version}/{SCHEMA_VERSION}'
+
+UNIT_TABLES = ['cell_maps', 'cells', 'packages', 'parts', 'animations', 'labels', 'user_data']
+
+
+def _enum_name(value):
+    return value.name if value is not None else None
+
+
+def _join(values):
+    return ','.join(str(value) for value in values) if values is not None else None
+
+
+class Catalog:
+    # SQLite index of the metadata of every unit, so it can be looked up without parsing the .ssbp files
+    # Usage example:
+    # catalog = Catalog('catalog.sqlite')
+    # catalog.update('data/Unit')
+    # catalog.animations_with_label('attack')
+    def __init__(self, path='catalog.sqlite'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        # Catalogs from before the indexer column get it added, their units are then all re-indexed
+        columns = [row['name'] for row in self.connection.execute('PRAGMA table_info(files)')]
+        if 'indexer' not in columns:
+            with self.connection:
+                self.connection.execute('ALTER TABLE files ADD COLUMN indexer TEXT')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, data_path='data/Unit', debug=False):
+        # Re-index the units whose .ssbp changed or that were indexed by another version, drop the removed ones,
+        # returns the lists of updated and removed units
+        indexed = {row['unit']: (row['mtime'], row['size'], row['indexer'])
+                   for row in self.connection.execute('SELECT unit, mtime, size, indexer FROM files')}
+        found = set()
+        updated = []
+        for unit in sorted(os.listdir(data_path)):
+            path = os.path.join(data_path, unit, f'{unit}.ssbp')
+            if not os.path.isfile(path):
+                continue
+            found.add(unit)
+            stat = os.stat(path)
+            if indexed.get(unit) == (stat.st_mtime, stat.st_size, INDEXER_VERSION):
+                continue
+            if debug:
+                print(f'Indexing {unit}')
+            self.index_unit(unit, path, stat)
+            updated.append(unit)
+
+        removed = sorted(set(indexed) - found)
+        with self.connection:
+            for unit in removed:
+                self._delete_unit(unit)
+        return updated, removed
+
+    def _delete_unit(self, unit):
+        self.connection.execute('DELETE FROM files WHERE unit = ?', (unit,))
+        for table in UNIT_TABLES:
+            self.connection.execute(f'DELETE FROM {table} WHERE unit = ?', (unit,))
+
+    def index_unit(self, unit, path, stat=None):
+        stat = stat or os.stat(path)
+        try:
+            with open(path, 'rb') as file:
+                ssbp = SSBP(file)
+            error = None
+        except Exception as exception:
+            # Keep the failure in the index so the file isn't re-parsed until it or the parser changes
+            ssbp = None
+            error = repr(exception)
+
+        with self.connection:
+            self._delete_unit(unit)
+            self.connection.execute(
+                'INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (unit, path, stat.st_mtime, stat.st_size, ssbp.version if ssbp else None, error, INDEXER_VERSION)
+            )
+            if ssbp:
+                self._insert_ssbp(unit, ssbp)
+
+    def _insert_ssbp(self, unit, ssbp):
+        execute = self.connection.executemany
+        execute('INSERT INTO cell_maps VALUES (?, ?, ?, ?, ?)', [
+            (unit, cell_map['name'], cell_map['image path'],
+             _enum_name(cell_map['wrap mode']), _enum_name(cell_map['filter mode']))
+            for cell_map in ssbp.cell_maps.values()
+        ])
+        execute('INSERT INTO cells VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+            (unit, cell_map['name'], cell['name'], cell['index'], cell['pos'][0], cell['pos'][1],
+             cell['size'][0], cell['size'][1], cell['pivot'][0], cell['pivot'][1])
+            for cell_map in ssbp.cell_maps.values() for cell in cell_map['cells']
+        ])
+        for package in ssbp.animation_packages:
+            animations = package['animations']['data']
+            execute('INSERT INTO packages VALUES (?, ?, ?, ?)', [
+                (unit, package['name'], len(package['animation parts']['data']), len(animations))
+            ])
+            execute('INSERT INTO parts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+                (unit, package['name'], part['name'], part['index'], part['parent index'],
+                 _enum_name(part['type']), _enum_name(part['bounds type']), _enum_name(part['alpha blend type']),
+                 part['animation instance name'] or None, part['effect name'] or None)
+                for part in package['animation parts']['data']
+            ])
+            execute('INSERT INTO animations VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                (unit, package['name'], animation['name'], animation['frame count'], animation['fps'],
+                 animation['canvas size'][0], animation['canvas size'][1])
+                for animation in animations
+            ])
+            execute('INSERT INTO labels VALUES (?, ?, ?, ?, ?)', [
+                (unit, package['name'], animation['name'], label, time)
+                for animation in animations for label, time in animation['label data']['data'].items()
+            ])
+            execute('INSERT INTO user_data VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+                (unit, package['name'], animation['name'], frame, event['part index'], event.get('integer'),
+                 _join(event.get('rect')), _join(event.get('point')), event.get('string'))
+                for animation in animations
+                for frame, events in animation['user data']['data'].items() for event in events
+            ])
+
+    # Queries, every query returns a list of dictionaries
+
+    def query(self, sql, parameters=()):
+        return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+    def units(self):
+        return [row['unit'] for row in self.query('SELECT unit FROM files WHERE error IS NULL ORDER BY unit')]
+
+    def errors(self):
+        return self.query('SELECT unit, path, error FROM files WHERE error IS NOT NULL ORDER BY unit')
+
+    def cell_maps(self, unit):
+        return self.query('SELECT * FROM cell_maps WHERE unit = ?', (unit,))
+
+    def cells(self, unit, cell_map=None):
+        if cell_map is None:
+            return self.query('SELECT * FROM cells WHERE unit = ? ORDER BY cell_index', (unit,))
+        return self.query('SELECT * FROM cells WHERE unit = ? AND cell_map = ? ORDER BY cell_index', (unit, cell_map))
+
+    def packages(self, unit):
+        return self.query('SELECT * FROM packages WHERE unit = ?', (unit,))
+
+    def parts(self, unit, package):
+        return self.query('SELECT * FROM parts WHERE unit = ? AND package = ? ORDER BY part_index', (unit, package))
+
+    def animations(self, unit=None, package=None, name=None):
+        conditions, parameters = [], []
+        for column, value in [('unit', unit), ('package', package), ('name', name)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self.query(f'SELECT * FROM animations {where} ORDER BY unit, package, name', parameters)
+
+    def frame_counts(self, animation_name):
+        # Frame count of the animation with this name in every unit
+        return self.query(
+            'SELECT unit, package, name, frame_count, fps FROM animations WHERE name = ? ORDER BY unit, package',
+            (animation_name,)
+        )
+
+    def labels(self, unit, package, animation):
+        return {row['name']: row['time'] for row in self.query(
+            'SELECT name, time FROM labels WHERE unit = ? AND package = ? AND animation = ?',
+            (unit, package, animation)
+        )}
+
+    def user_data(self, unit=None, package=None, animation=None, start=None, end=None, string=None):
+        # User data events, optionally limited to an animation and the frames [start, end)
+        conditions, parameters = [], []
+        for column, value in [('unit', unit), ('package', package), ('animation', animation), ('string', string)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
+        if start is not None:
+            conditions.append('frame >= ?')
+            parameters.append(start)
+        if end is not None:
+            conditions.append('frame < ?')
+            parameters.append(end)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self.query(f'SELECT * FROM user_data {where} ORDER BY unit, package, animation, frame', parameters)
+
+    def animations_with_label(self, label):
+        return self.query(
+            'SELECT unit, package, animation, time FROM labels WHERE name = ? ORDER BY unit, package, animation',
+            (label,)
+        )
+
+
+if __name__ == "__main__":
+    with Catalog() as catalog:
+        updated, removed = catalog.update(debug=True)
+        print(f'{len(updated)} updated, {len(removed)} removed, {len(catalog.units())} indexed')
+        for error in catalog.errors():
+            print(f"! {error['unit']}: {error['error']}")
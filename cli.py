@@ -0,0 +1,386 @@
+import argparse
+import fnmatch
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ssbp import SSBP
+from dump_frames import dump_frames
+from export_frames import export_frames
+from split_cell import update_cellmap
+from sprite_store import SpriteStore
+from texture_cache import TextureCache
+from manifest import Manifest, texture_inputs
+from pipeline import Pipeline, out_of_date_frames, render_stages
+from frame_decoder import RENDER_QUALITIES, SSFrameDecoder
+from output import ENCODE_PROFILES
+from stream_frames import FrameStream, stream_animation
+from watch import watch
+from server import serve
+
+
+def parse_frames(value):
+    # Parse a frame selection such as "0", "0-5" or "0,3,10-12" into a set of frames
+    frames = set()
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '-' in item:
+            start, end = item.split('-', 1)
+            frames.update(range(int(start), int(end) + 1))
+        else:
+            frames.add(int(item))
+    return frames
+
+
+def find_units(data_path, patterns):
+    # Match the unit names and globs against the unit folders in the data path
+    available = sorted(name for name in os.listdir(data_path)
+                       if os.path.isfile(os.path.join(data_path, name, f'{name}.ssbp')))
+    units, missing = [], []
+    for pattern in patterns:
+        matches = fnmatch.filter(available, pattern)
+        if not matches:
+            missing.append(pattern)
+        for unit in matches:
+            if unit not in units:
+                units.append(unit)
+    return units, missing
+
+
+def _matches(name, patterns):
+    return not patterns or any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def load_unit(data_path, unit, debug=False):
+    with open(os.path.join(data_path, unit, f'{unit}.ssbp'), 'rb') as file:
+        return SSBP(file, debug=debug)
+
+
+def command_parse(unit, options):
+    ssbp = load_unit(options.data, unit, debug=options.debug)
+    lines = [f'{unit}: {ssbp.cells_count} cells, {ssbp.animation_pack_count} animation packages']
+    for package in ssbp.animation_packages:
+        if not _matches(package['name'], options.package):
+            continue
+        for animation in package['animations']['data']:
+            if _matches(animation['name'], options.animation):
+                lines.append(f"  {package['name']}/{animation['name']}: {animation['frame count']} frames "
+                             f"at {animation['fps']} fps, canvas {animation['canvas size']}")
+    return '\n'.join(lines)
+
+
+def _selected_names(ssbp, options):
+    # Names of the packages and animations matching the filters, None if no filter was given,
+    # so an empty set always means that nothing matched
+    if not options.package and not options.animation:
+        return None, None
+    packages, animations = set(), set()
+    for package in ssbp.animation_packages:
+        if _matches(package['name'], options.package):
+            packages.add(package['name'])
+            animations.update(animation['name'] for animation in package['animations']['data']
+                              if _matches(animation['name'], options.animation))
+    return packages, animations
+
+
+def command_dump(unit, options):
+    ssbp = load_unit(options.data, unit)
+    packages, animations = _selected_names(ssbp, options)
+    if animations is not None and not animations:
+        return f'{unit}: no animations match'
+    dump_frames(unit, ssbp, output_path=options.output, packages=packages, animations=animations)
+    if animations is None:
+        animations = {animation['name'] for package in ssbp.animation_packages
+                      for animation in package['animations']['data']}
+    return f'{unit}: dumped {len(animations)} animations'
+
+
+def load_manifest(unit, options):
+    manifest = Manifest(os.path.join(options.output, unit, 'manifest.json'))
+    if options.force:
+        manifest.artifacts.clear()
+    return manifest
+
+
+def texture_cache(options):
+    # Worker processes page the decoded atlases in from the shared cache instead of inflating the PNGs
+    if not options.texture_cache:
+        return None
+    return TextureCache.open(options.texture_cache)
+
+
+def sprite_store(options):
+    # Opened in the process running the unit, so every unit of the process shares the store's caches
+    if not options.store:
+        return None
+    return SpriteStore.open(os.path.join(options.output, '.sprites'), options.texture_profile)
+
+
+def command_export(unit, options):
+    ssbp = load_unit(options.data, unit)
+    packages, animations = _selected_names(ssbp, options)
+    if animations is not None and not animations:
+        return f'{unit}: no animations match'
+    written = export_frames(unit, ssbp, output_path=options.output, formats=options.format or ['jsonl'],
+                            packages=packages, animations=animations)
+    return f'{unit}: exported {len(written)} files'
+
+
+def command_split(unit, options):
+    ssbp = load_unit(options.data, unit)
+    manifest = load_manifest(unit, options)
+    if not update_cellmap(unit, ssbp, manifest, data_path=options.data, output_path=options.output,
+                          profile=options.texture_profile, index=options.index, store=sprite_store(options),
+                          texture_cache=texture_cache(options)):
+        return f'{unit}: up to date'
+    manifest.save()
+    return f'{unit}: split {ssbp.cells_count} cells'
+
+
+def command_render(unit, options):
+    manifest = load_manifest(unit, options)
+    # Skip the unit without parsing it if nothing changed since the last run with the same options
+    unit_inputs = {
+        'unit files': manifest.folder_hashes(os.path.join(options.data, unit)),
+        'options': [options.package, options.animation, sorted(options.frames or []),
+                    options.profile, options.texture_profile, options.index, options.store, options.canvas,
+                    options.quality, options.layers]
+    }
+    if manifest.is_up_to_date('render', unit_inputs, check_exists=False) and \
+            all(os.path.exists(os.path.join(manifest.root, artifact)) for artifact in manifest.artifacts
+                if artifact != 'render'):
+        return f'{unit}: up to date'
+
+    ssbp = load_unit(options.data, unit)
+    unit_output_path = os.path.join(options.output, unit)
+    update_cellmap(unit, ssbp, manifest, data_path=options.data, output_path=options.output,
+                   profile=options.texture_profile, index=options.index, store=sprite_store(options),
+                   texture_cache=texture_cache(options))
+    textures = texture_inputs(manifest, ssbp, options.data, unit)
+
+    decoder = SSFrameDecoder(ssbp, export_path=unit_output_path, texture_profile=options.texture_profile,
+                             texture_cache=texture_cache(options))
+    # Frames are checked against the manifest here, rendered and encoded on the pipeline's threads
+    counts = {'rendered': 0, 'skipped': 0}
+    frames = out_of_date_frames(unit, decoder, manifest, textures, options.output, options.profile, options.canvas,
+                                options.quality, options.layers, options.package, options.animation, options.frames,
+                                counts)
+    pipeline = Pipeline(render_stages(options.profile, options.canvas, options.quality, options.layers,
+                                      debug=options.debug, workers=options.threads, counts=counts))
+    errors = pipeline.run(frames)
+
+    # Frames that were written are kept even if others failed
+    if not errors:
+        manifest.record('render', unit_inputs)
+    manifest.save()
+    if errors:
+        raise errors[0][2]
+    return f"{unit}: rendered {counts['rendered']} frames, {counts['skipped']} up to date"
+
+
+def command_stream(unit, options):
+    ssbp = load_unit(options.data, unit)
+    manifest = load_manifest(unit, options)
+    if update_cellmap(unit, ssbp, manifest, data_path=options.data, output_path=options.output,
+                      profile=options.texture_profile, index=options.index, store=sprite_store(options),
+                      texture_cache=texture_cache(options)):
+        manifest.save()
+
+    decoder = SSFrameDecoder(ssbp, export_path=os.path.join(options.output, unit),
+                             texture_profile=options.texture_profile, texture_cache=texture_cache(options))
+    written = 0
+    for package_name, package in decoder.animation_packages.items():
+        if not _matches(package_name, options.package):
+            continue
+        for animation_name, animation in package['animations'].items():
+            if not _matches(animation_name, options.animation):
+                continue
+            written += stream_animation(decoder, options.stream, package_name, animation_name, frames=options.frames,
+                                        loops=options.loops, canvas=options.canvas, quality=options.quality)
+            size, _ = decoder.canvas_layout(package_name, animation_name, options.canvas,
+                                            RENDER_QUALITIES[options.quality]['scale'])
+            print(f"{unit} {package_name}/{animation_name}: {size[0]}x{size[1]} at {animation['fps']} fps",
+                  file=sys.stderr)
+    return f'{unit}: streamed {written} frames'
+
+
+COMMANDS = {
+    'parse': command_parse,
+    'dump': command_dump,
+    'export': command_export,
+    'split': command_split,
+    'render': command_render,
+    'stream': command_stream,
+}
+
+
+def run_unit(command, unit, options):
+    # Runs in the worker process, errors are returned instead of raised so one unit can't stop the batch
+    try:
+        return unit, COMMANDS[command](unit, options), None
+    except Exception as error:
+        details = traceback.format_exc() if options.debug else None
+        message = f'{type(error).__name__}: {error}' if str(error) else type(error).__name__
+        return unit, None, (message, details)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='feh-ssbp', description='SSBP decompiler for Fire Emblem Heroes files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # Options are split into groups, so every subcommand only takes the options it uses
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('units', nargs='+', help='unit names or globs, e.g. ch04_12_Tiki_F_Normal or "ch04_*"')
+    common.add_argument('--data', default='data/Unit', help='folder containing the unit folders (default: %(default)s)')
+    common.add_argument('--output', default='output', help='output folder (default: %(default)s)')
+    common.add_argument('--debug', action='store_true', help='print debug output and tracebacks')
+
+    selection = argparse.ArgumentParser(add_help=False)
+    selection.add_argument('--package', action='append', help='only process matching animation packages, repeatable')
+    selection.add_argument('--animation', action='append', help='only process matching animations, repeatable')
+
+    frames = argparse.ArgumentParser(add_help=False)
+    frames.add_argument('--frames', type=parse_frames, help='only render these frames, e.g. "0,5-10"')
+
+    jobs = argparse.ArgumentParser(add_help=False)
+    jobs.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                      help='units processed in parallel (default: %(default)s)')
+
+    force = argparse.ArgumentParser(add_help=False)
+    force.add_argument('--force', action='store_true', help='rebuild outputs even if they are up to date')
+
+    profile = argparse.ArgumentParser(add_help=False)
+    profile.add_argument('--profile', choices=sorted(ENCODE_PROFILES), default='compact',
+                         help='encode profile of rendered frames (default: %(default)s)')
+
+    cells = argparse.ArgumentParser(add_help=False)
+    cells.add_argument('--texture-profile', choices=sorted(ENCODE_PROFILES), default='fast',
+                       help='encode profile of split cells (default: %(default)s)')
+    cells.add_argument('--index', action='store_true',
+                       help='write an index of the cells in the atlases instead of a file per cell')
+    cells.add_argument('--store', action='store_true',
+                       help='store the cells once for every unit in <output>/.sprites, keyed by their pixels')
+    cells.add_argument('--texture-cache',
+                       help='folder of decoded atlases memory-mapped by every worker process, e.g. output/.textures')
+
+    rendering = argparse.ArgumentParser(add_help=False)
+    rendering.add_argument('--canvas', choices=['auto'],
+                           help='"auto" crops the canvas to the bounds of the animation instead of the authored canvas')
+    rendering.add_argument('--quality', choices=list(RENDER_QUALITIES), default='full',
+                           help='output scale and resample filter, preview and thumbnail are fast downscaled renders '
+                                '(default: %(default)s)')
+
+    subparsers.add_parser('parse', parents=[common, selection, jobs], help='parse the units and print a summary')
+    subparsers.add_parser('dump', parents=[common, selection, jobs], help='dump the frame data as text')
+    export = subparsers.add_parser('export', parents=[common, selection, jobs],
+                                   help='export the frame data as JSON Lines or NumPy .npz')
+    export.add_argument('--format', action='append', choices=['jsonl', 'npz'],
+                        help='export format, repeatable (default: jsonl)')
+    subparsers.add_parser('split', parents=[common, jobs, force, cells], help='split the cell maps into cell images')
+
+    render = subparsers.add_parser('render', help='render the animation frames',
+                                   parents=[common, selection, frames, jobs, force, profile, cells, rendering])
+    render.add_argument('--layers', action='store_true',
+                        help='write every frame as cropped part layers in a sheet plus a JSON file instead of one image')
+    render.add_argument('--threads', type=int, default=4,
+                        help='frames of a unit rendered and encoded at once (default: %(default)s)')
+    # Every unit writes to the same stream, so units are streamed one after the other
+    stream = subparsers.add_parser('stream', parents=[common, selection, frames, force, cells, rendering],
+                                   help='render the animations as raw RGBA frames to stdout, a pipe or a socket')
+    stream.add_argument('--to', default='-',
+                        help='"-" for stdout, a file or named pipe path, or unix:<path> for a Unix socket '
+                             '(default: %(default)s)')
+    stream.add_argument('--header', action='store_true',
+                        help='precede every frame with a header giving its size, origin and duration')
+    stream.add_argument('--loops', type=int, default=1, help='times every animation is streamed (default: %(default)s)')
+    watch_parser = subparsers.add_parser('watch', parents=[common, selection, profile, cells, rendering],
+                                         help='render the units, then render again what changes until interrupted')
+    watch_parser.add_argument('--interval', type=float, default=0.5,
+                              help='seconds between checks for changed files (default: %(default)s)')
+    serve_parser = subparsers.add_parser('serve', help='serve rendered frames and metadata over HTTP')
+    serve_parser.add_argument('--data', default='data/Unit', help='folder containing the unit folders (default: %(default)s)')
+    serve_parser.add_argument('--output', default='output', help='output folder (default: %(default)s)')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    serve_parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: %(default)s)')
+    serve_parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                              help='render worker threads (default: %(default)s)')
+    serve_parser.add_argument('--profile', choices=sorted(ENCODE_PROFILES), default='fast',
+                              help='encode profile of served images (default: %(default)s)')
+    serve_parser.add_argument('--units-cached', type=int, default=16,
+                              help='parsed units kept in memory (default: %(default)s)')
+    serve_parser.add_argument('--responses-cached', type=int, default=512,
+                              help='encoded frames and sheets kept in memory (default: %(default)s)')
+    serve_parser.add_argument('--texture-cache', help='folder of a texture cache shared with other processes')
+    return parser
+
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    if not os.path.isdir(options.data):
+        print(f"! Data folder {options.data} wasn't found", file=sys.stderr)
+        return 2
+    if options.command == 'serve':
+        serve(options.data, host=options.host, port=options.port, output_path=options.output, profile=options.profile,
+              workers=options.jobs, unit_cache_size=options.units_cached,
+              response_cache_size=options.responses_cached, texture_cache_path=options.texture_cache)
+        return 0
+    if options.command == 'watch':
+        # Runs until interrupted, units that appear while watching are picked up too
+        try:
+            watch(options.units, data_path=options.data, interval=options.interval, debug=options.debug,
+                  output_path=options.output, profile=options.profile, texture_profile=options.texture_profile,
+                  canvas=options.canvas,
+                  quality=options.quality, packages=options.package, animations=options.animation,
+                  index=options.index, store=sprite_store(options), texture_cache=texture_cache(options))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    units, missing = find_units(options.data, options.units)
+    for pattern in missing:
+        print(f'! No units match {pattern}', file=sys.stderr)
+
+    # Status messages go to stderr when the frames are streamed to stdout
+    messages = sys.stdout
+    if options.command == 'stream':
+        options.jobs = 1
+        options.stream = FrameStream(options.to, header=options.header)
+        messages = sys.stderr
+        # Anything printed while rendering, e.g. --debug output, must not end up between the frames
+        stdout, sys.stdout = sys.stdout, sys.stderr
+
+    errors = {}
+    if options.jobs > 1 and len(units) > 1:
+        with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+            futures = [executor.submit(run_unit, options.command, unit, options) for unit in units]
+            results = (future.result() for future in as_completed(futures))
+            for unit, message, error in results:
+                if error:
+                    errors[unit] = error
+                elif message:
+                    print(message, file=messages)
+    else:
+        for unit in units:
+            unit, message, error = run_unit(options.command, unit, options)
+            if error:
+                errors[unit] = error
+            elif message:
+                print(message, file=messages)
+
+    if options.command == 'stream':
+        options.stream.close()
+        sys.stdout = stdout
+
+    if errors:
+        print(f'\n{len(errors)} of {len(units)} units failed:', file=sys.stderr)
+        for unit in sorted(errors):
+            message, details = errors[unit]
+            print(f'! {unit}: {message}', file=sys.stderr)
+            if details:
+                print(details, file=sys.stderr)
+    return 1 if errors or missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
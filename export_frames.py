@@ -0,0 +1,221 @@
+import json
+import os
+from ssbp import SSBP
+
+# Frame data export, one file per animation, named <package>-<animation>.jsonl / .npz
+#
+# JSON Lines (version 1), one JSON object per line:
+#   header   {"type": "header", "format": "feh-ssbp-frames", "version": 1, "unit": ..., "package": ...,
+#             "animation": ..., "frame count": ..., "fps": ..., "canvas size": [w, h], "labels": {name: time},
+#             "user data": {frame: [{"part index", "integer", "rect", "point", "string"}, ...]},
+#             "parts": [{"name", "index", "parent index", "type", "bounds type", "alpha blend type",
+#                        "animation instance name", "effect name", "color"}, ...]}
+#   initial  {"type": "initial", "part": part index, "data": {attribute: value}}, one per part
+#   frame    {"type": "frame", "frame": time, "part": part index, "data": {attribute: value}},
+#            one per part per frame, data only holds the attributes stored in that frame,
+#            the rest come from the initial data
+#
+# NumPy .npz (version 1), columnar:
+#   "meta"                     JSON string with the header above, without "type"
+#   "initial.<attribute>"      (parts,) values of the initial data
+#   "frame.<attribute>"        (frames, parts) values, zero where the attribute isn't stored
+#   "frame.<attribute>.mask"   (frames, parts) bools, True where the attribute is stored in the frame
+# Nested attributes are flattened into "<attribute>.<key>" columns, attributes holding lists
+# (e.g. vertex transform) are stored as JSON strings.
+#
+# Attribute names are the ones used by the parser, e.g. "position x" or "cell index".
+
+FORMAT_NAME = 'feh-ssbp-frames'
+FORMAT_VERSION = 1
+
+# Column types for the NumPy export, anything else is stored as JSON strings
+COLUMN_TYPES = {
+    'invisible': 'bool',
+    'flip h': 'bool',
+    'flip v': 'bool',
+    'cell index': 'int16',
+    'position x': 'int16',
+    'position y': 'int16',
+    'position z': 'int16',
+    'opacity': 'int16',
+    'pivot x': 'float32',
+    'pivot y': 'float32',
+    'rotation x': 'float32',
+    'rotation y': 'float32',
+    'rotation z': 'float32',
+    'scale x': 'float32',
+    'scale y': 'float32',
+    'size x': 'float32',
+    'size y': 'float32',
+    'u move': 'float32',
+    'v move': 'float32',
+    'uv rotation': 'float32',
+    'u scale': 'float32',
+    'v scale': 'float32',
+    'bounding radius': 'float32',
+    'instance keyframe': 'int16',
+    'instance start': 'int16',
+    'instance end': 'int16',
+    'instance speed': 'float32',
+    'instance loop': 'int16',
+    'instance loop flags.infinity': 'bool',
+    'instance loop flags.reverse': 'bool',
+    'instance loop flags.pingpong': 'bool',
+    'instance loop flags.independent': 'bool',
+}
+
+
+def _json_value(value):
+    # Enums are written by name
+    if hasattr(value, 'name') and hasattr(value, 'value'):
+        return value.name
+    raise TypeError(f'{value!r} is not JSON serializable')
+
+
+def _header(unit, package, animation):
+    return {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'unit': unit,
+        'package': package['name'],
+        'animation': animation['name'],
+        'frame count': animation['frame count'],
+        'fps': animation['fps'],
+        'canvas size': list(animation['canvas size']),
+        'labels': animation['label data']['data'],
+        'user data': animation['user data']['data'],
+        'parts': package['animation parts']['data'],
+    }
+
+
+def _attributes(frame):
+    # Attribute values of a frame, without the part index
+    return {key: value for key, value in frame.items() if key not in ('part index', 'flags value')}
+
+
+def write_jsonl(path, unit, package, animation):
+    with open(path, 'w') as output:
+        def write(record):
+            output.write(json.dumps(record, default=_json_value, separators=(',', ':')) + '\n')
+
+        write(dict(type='header', **_header(unit, package, animation)))
+        for part_index, frames in sorted(animation['initial frame data']['data'].items()):
+            write({'type': 'initial', 'part': part_index, 'data': _attributes(frames[0])})
+        parts = sorted(animation['frame data']['data'].items())
+        for time in range(animation['frame count']):
+            for part_index, frames in parts:
+                write({'type': 'frame', 'frame': time, 'part': part_index, 'data': _attributes(frames[time])})
+
+
+def load_jsonl(path):
+    # Returns the header, the initial data as {part: data} and the frame data as {part: [data per frame]}
+    header, initial, frames = None, {}, {}
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            if record['type'] == 'header':
+                if record['format'] != FORMAT_NAME or record['version'] > FORMAT_VERSION:
+                    raise ValueError(f"{path} is {record['format']} version {record['version']}, "
+                                     f"only {FORMAT_NAME} up to version {FORMAT_VERSION} is supported")
+                header = record
+            elif record['type'] == 'initial':
+                initial[record['part']] = record['data']
+            elif record['type'] == 'frame':
+                frames.setdefault(record['part'], []).append(record['data'])
+    return header, initial, frames
+
+
+def _flatten(data):
+    values = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                values[f'{key}.{sub_key}'] = sub_value
+        else:
+            values[key] = value
+    return values
+
+
+def _column(numpy, values, dtype, shape):
+    if dtype is None:
+        column = numpy.full(shape, '', dtype=object)
+        for index, value in values.items():
+            column[index] = json.dumps(value, default=_json_value)
+        return column.astype(str)
+    column = numpy.zeros(shape, dtype=dtype)
+    for index, value in values.items():
+        column[index] = value
+    return column
+
+
+def write_npz(path, unit, package, animation, compressed=True):
+    import numpy
+
+    part_indices = sorted(animation['initial frame data']['data'])
+    part_positions = {part_index: position for position, part_index in enumerate(part_indices)}
+    frame_count = animation['frame count']
+
+    initial, frame_values = {}, {}
+    for part_index in part_indices:
+        for key, value in _flatten(_attributes(animation['initial frame data']['data'][part_index][0])).items():
+            initial.setdefault(key, {})[part_positions[part_index]] = value
+    for part_index, frames in animation['frame data']['data'].items():
+        for time, frame in enumerate(frames):
+            for key, value in _flatten(_attributes(frame)).items():
+                frame_values.setdefault(key, {})[(time, part_positions[part_index])] = value
+
+    arrays = {'meta': numpy.array(json.dumps(_header(unit, package, animation), default=_json_value))}
+    for key, values in initial.items():
+        arrays[f'initial.{key}'] = _column(numpy, values, COLUMN_TYPES.get(key), (len(part_indices),))
+    for key, values in frame_values.items():
+        shape = (frame_count, len(part_indices))
+        arrays[f'frame.{key}'] = _column(numpy, values, COLUMN_TYPES.get(key), shape)
+        mask = numpy.zeros(shape, dtype=bool)
+        for index in values:
+            mask[index] = True
+        arrays[f'frame.{key}.mask'] = mask
+
+    (numpy.savez_compressed if compressed else numpy.savez)(path, **arrays)
+
+
+def load_npz(path):
+    # Returns the header and the dictionary of columns
+    import numpy
+
+    with numpy.load(path) as file:
+        header = json.loads(str(file['meta']))
+        if header['format'] != FORMAT_NAME or header['version'] > FORMAT_VERSION:
+            raise ValueError(f"{path} is {header['format']} version {header['version']}, "
+                             f"only {FORMAT_NAME} up to version {FORMAT_VERSION} is supported")
+        columns = {key: file[key] for key in file.files if key != 'meta'}
+    return header, columns
+
+
+def export_frames(unit, ssbp, output_path='output', formats=('jsonl',), packages=None, animations=None):
+    # Export the frame data of every animation, one animation at a time, returns the written paths
+    frames_path = os.path.join(output_path, unit, 'frames')
+    os.makedirs(frames_path, exist_ok=True)
+    written = []
+    for package in ssbp.animation_packages:
+        if packages is not None and package['name'] not in packages:
+            continue
+        for animation in package['animations']['data']:
+            if animations is not None and animation['name'] not in animations:
+                continue
+            name = os.path.join(frames_path, f"{package['name']}-{animation['name']}")
+            if 'jsonl' in formats:
+                write_jsonl(f'{name}.jsonl', unit, package, animation)
+                written.append(f'{name}.jsonl')
+            if 'npz' in formats:
+                write_npz(f'{name}.npz', unit, package, animation)
+                written.append(f'{name}.npz')
+    return written
+
+
+if __name__ == "__main__":
+    unit = 'ch04_12_Tiki_F_Normal'
+
+    with open(f'data/Unit/{unit}/{unit}.ssbp', 'rb') as file:
+        ssbp = SSBP(file)
+        for path in export_frames(unit, ssbp, formats=('jsonl', 'npz')):
+            print(path)
@@ -0,0 +1,101 @@
+import json
+import math
+import os
+from PIL import Image
+from output import load_image, save_image
+
+# Layered frame export, one sheet image plus one JSON file per frame, named
+# <package>-<animation>-<time>.layers.json and <package>-<animation>-<time>.layers.png (or the profile's extension)
+#
+# JSON (version 1):
+#   {"format": "feh-ssbp-layers", "version": 1, "canvas size": [w, h], "sheet": file name of the sheet,
+#    "layers": [{"name", "part index", "z", "offset": [x, y], "rect": [x, y, w, h], "blend", "color blend",
+#                "instance"}, ...]}
+# Layers are listed in draw order, "z" counts up from the bottom layer. "offset" is the position of the layer
+# on the canvas, "rect" its position and size in the sheet. "blend" is the part's alpha blend type,
+# "color blend" the color blend type applied to the layer (already baked into its pixels) or null,
+# "instance" the instanced animation, flattened into one layer, or null.
+# Layers are cropped to their visible pixels, drawing every layer at its offset gives the rendered frame.
+
+FORMAT_NAME = 'feh-ssbp-layers'
+FORMAT_VERSION = 1
+
+
+def crop_layer(sprite, dest, canvas_size):
+    # Visible part of the sprite drawn at dest, as (image, offset), None if nothing of it is visible
+    bbox = sprite.getchannel('A').getbbox() if sprite.mode == 'RGBA' else sprite.getbbox()
+    if bbox is None:
+        return None
+    left, top = max(bbox[0], -dest[0]), max(bbox[1], -dest[1])
+    right, bottom = min(bbox[2], canvas_size[0] - dest[0]), min(bbox[3], canvas_size[1] - dest[1])
+    if left >= right or top >= bottom:
+        return None
+    return sprite.crop((left, top, right, bottom)), (dest[0] + left, dest[1] + top)
+
+
+def pack_sheet(sizes):
+    # Shelf packing, tallest layers first, returns the position of every size and the size of the sheet
+    if not sizes:
+        return [], (1, 1)
+    width = max(max(size[0] for size in sizes), math.ceil(math.sqrt(sum(w * h for w, h in sizes))))
+    positions = [None] * len(sizes)
+    x = y = shelf_height = 0
+    for index in sorted(range(len(sizes)), key=lambda index: -sizes[index][1]):
+        w, h = sizes[index]
+        if x + w > width:
+            x, y = 0, y + shelf_height
+            shelf_height = 0
+        positions[index] = (x, y)
+        x += w
+        shelf_height = max(shelf_height, h)
+    return positions, (width, y + shelf_height)
+
+
+def save_layers(layers, canvas_size, path, profile='compact'):
+    # Write the layers collected by SSFrameDecoder.render_frame(layers=[...]), path is without extension,
+    # returns the path of the JSON file
+    positions, sheet_size = pack_sheet([layer['image'].size for layer in layers])
+    sheet = Image.new('RGBA', sheet_size, (0, 0, 0, 0))
+    for layer, position in zip(layers, positions):
+        sheet.paste(layer['image'], position)
+    sheet_path = save_image(sheet, f'{path}.layers.png', profile)
+
+    header = {
+        'format': FORMAT_NAME,
+        'version': FORMAT_VERSION,
+        'canvas size': list(canvas_size),
+        'sheet': os.path.basename(sheet_path),
+        'layers': [
+            dict({key: value for key, value in layer.items() if key != 'image'},
+                 offset=list(layer['offset']), rect=list(position + layer['image'].size))
+            for layer, position in zip(layers, positions)
+        ]
+    }
+    json_path = f'{path}.layers.json'
+    with open(json_path, 'w') as file:
+        json.dump(header, file, indent=1)
+    return json_path
+
+
+def load_layers(path):
+    # Returns the header and the layers with their images cut out of the sheet
+    with open(path) as file:
+        header = json.load(file)
+    if header['format'] != FORMAT_NAME or header['version'] > FORMAT_VERSION:
+        raise ValueError(f"{path} is {header['format']} version {header['version']}, "
+                         f"only {FORMAT_NAME} up to version {FORMAT_VERSION} is supported")
+    sheet = load_image(os.path.join(os.path.dirname(path), header['sheet']))
+    layers = []
+    for layer in header['layers']:
+        x, y, width, height = layer['rect']
+        layers.append(dict(layer, image=sheet.crop((x, y, x + width, y + height))))
+    return header, layers
+
+
+def flatten_layers(header, layers):
+    # Draw the layers back into a single frame
+    canvas = Image.new('RGBA', tuple(header['canvas size']), (255, 255, 255, 0))
+    for layer in sorted(layers, key=lambda layer: layer['z']):
+        canvas.alpha_composite(layer['image'].convert('RGBA'), dest=tuple(layer['offset']))
+    return canvas
+
@@ -1,128 +1,475 @@
 import os
+import json
 import math
+import sys
+import threading
+from collections import OrderedDict
 from ssbp import SSBP
-from PIL import Image
-from PIL.Image import alpha_composite
-from split_cell import split_cellmap
-from sstypes import SSCell, SSVector2, SSAnimationPart, SSPartState
-from utility import create_identity_matrix, translation_matrix_m, rotation_matrix_m, scale_matrix_m
-
-
-# Override the Image class to disable the check for destination value < 0
-class _Image(Image.Image):
-    def alpha_composite(self, im, dest=(0,0), source=(0,0)):
-        if not isinstance(source, (list, tuple)):
-            raise ValueError("Source must be a tuple")
-        if not isinstance(dest, (list, tuple)):
-            raise ValueError("Destination must be a tuple")
-        if not len(source) in (2, 4):
-            raise ValueError("Source must be a 2 or 4-tuple")
-        if not len(dest) == 2:
-            raise ValueError("Destination must be a 2-tuple")
-        if min(source) < 0:
-            raise ValueError("Source must be non-negative")
-        if len(source) == 2:
-            source = source + im.size
-        if source == (0,0) + im.size:
-            overlay = im
-        else:
-            overlay = im.crop(source)
-        box = dest + (dest[0] + overlay.width, dest[1] + overlay.height)
-        if box == (0,0) + self.size:
-            background = self
-        else:
-            background = self.crop(box)
-        result = alpha_composite(background, overlay)
-        self.paste(result, box)
-Image.Image = _Image
+from PIL import Image, ImageChops
+from split_cell import update_cellmap, INDEX_NAME
+from manifest import Manifest
+from output import load_image, output_path, save_image
+from texture_cache import mip_level
+from export_layers import crop_layer, save_layers
+from sprite_store import load_mapping
+from sstypes import SSCell, SSVector2, SSAnimationPart, SSPartState, SSPartType, SSBlendType, SSUserDataIndex, \
+    AnimationInstance
+from utility import LRUCache, create_identity_matrix, translation_matrix_m, rotation_matrix_m, scale_matrix_m
+
+
+def composite(canvas, sprite, dest):
+    # Alpha composite the sprite onto the canvas in place, Image.alpha_composite rejects negative
+    # destinations, so the sprite is clipped to the canvas first
+    x, y = dest
+    left, top = max(-x, 0), max(-y, 0)
+    right, bottom = min(sprite.width, canvas.width - x), min(sprite.height, canvas.height - y)
+    if left >= right or top >= bottom:
+        return
+    canvas.alpha_composite(sprite, dest=(x + left, y + top), source=(left, top, right, bottom))
+
+
+# The animation origin sits this far below the center of the authored canvas
+ORIGIN_OFFSET_Y = 95
+
+# Output scale and resample filter of a render, downscaled renders sample the sprites from the mip level
+# of the texture closest to the output scale, so a half size preview does about a quarter of the work.
+# render_frame also accepts a dictionary with the same keys
+RENDER_QUALITIES = {
+    'full': {'scale': 1, 'resample': Image.BICUBIC},
+    'double': {'scale': 2, 'resample': Image.BICUBIC},
+    'preview': {'scale': 0.5, 'resample': Image.BILINEAR},
+    'thumbnail': {'scale': 0.25, 'resample': Image.NEAREST},
+}
+
+
+def render_quality(quality):
+    # Scale and resample filter of a quality name or dictionary
+    if not isinstance(quality, dict):
+        quality = RENDER_QUALITIES[quality]
+    return quality.get('scale', 1), quality.get('resample', Image.BICUBIC)
+
+
+def mip_level_for(scale):
+    # Largest mip level that's still at least the size of the output
+    level = 0
+    while scale * 2 ** (level + 1) <= 1:
+        level += 1
+    return level
+
+
+def rotated_size(size, angle, center=None):
+    # Size of the image after Image.rotate(angle, expand=True, center=center), without rotating it
+    width, height = size
+    angle = angle % 360.0
+    if not center:
+        # Without a center Pillow transposes right angles instead of rotating them
+        if angle in (90.0, 270.0):
+            return height, width
+        if angle in (0.0, 180.0):
+            return width, height
+        center = (width / 2, height / 2)
+    angle = -math.radians(angle)
+    matrix = [round(math.cos(angle), 15), round(math.sin(angle), 15), 0.0,
+              round(-math.sin(angle), 15), round(math.cos(angle), 15), 0.0]
+
+    def transform(x, y):
+        return matrix[0] * x + matrix[1] * y + matrix[2], matrix[3] * x + matrix[4] * y + matrix[5]
+
+    matrix[2], matrix[5] = transform(-center[0], -center[1])
+    matrix[2] += center[0]
+    matrix[5] += center[1]
+    corners = [transform(x, y) for x, y in ((0, 0), (width, 0), (width, height), (0, height))]
+    return (math.ceil(max(x for x, _ in corners)) - math.floor(min(x for x, _ in corners)),
+            math.ceil(max(y for _, y in corners)) - math.floor(min(y for _, y in corners)))
+
+
+def transform_points(points, size, state):
+    # Follow points of an image through the flips, scaling and rotation applied to instanced canvases,
+    # returns the moved points and the size of the transformed image
+    width, height = size
+    if state.flph or state.sclx < 0:
+        points = [(width - x, y) for x, y in points]
+    if state.flpv or state.scly < 0:
+        points = [(x, height - y) for x, y in points]
+    if abs(state.sclx) != 1.0 or abs(state.scly) != 1.0:
+        scaled = (max(round(abs(state.sclx) * width), 1), max(round(abs(state.scly) * height), 1))
+        points = [(x * scaled[0] / width, y * scaled[1] / height) for x, y in points]
+        width, height = scaled
+    angle = round(state.rotz + state._rotz)
+    if angle:
+        # Counter-clockwise around the center, then shifted into the expanded image
+        expanded = rotated_size((width, height), angle)
+        radians = math.radians(angle)
+        cx, cy = width / 2, height / 2
+        points = [(cx + (x - cx) * math.cos(radians) + (y - cy) * math.sin(radians) + (expanded[0] - width) / 2,
+                   cy - (x - cx) * math.sin(radians) + (y - cy) * math.cos(radians) + (expanded[1] - height) / 2)
+                  for x, y in points]
+        width, height = expanded
+    return points, (width, height)
+
+
+def union_bounds(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def apply_color_blend(sprite, color_blend):
+    # Blend the sprite's color with the part's blend color, keeps the sprite's alpha.
+    # Works on whole images, per-vertex colors and rates are interpolated across the quad
+    # by resizing a 2x2 image of the vertex values
+    if sprite.mode != 'RGBA':
+        sprite = sprite.convert('RGBA')
+    colors = [color or {'rate': 0.0, 'rgba': (0, 0, 0, 0)} for color in color_blend['colors']]
+    # The color's alpha scales the blend rate
+    rates = [round(255 * max(0.0, min(color['rate'], 1.0)) * color['rgba'][3] / 255) for color in colors]
+
+    if color_blend['single']:
+        color = Image.new('RGB', sprite.size, colors[0]['rgba'][:3])
+        rate = Image.new('L', sprite.size, rates[0])
+    else:
+        # Vertices are in top left, top right, bottom left, bottom right order
+        color = Image.new('RGB', (2, 2))
+        color.putdata([color['rgba'][:3] for color in colors])
+        color = color.resize(sprite.size, resample=Image.BILINEAR)
+        rate = Image.new('L', (2, 2))
+        rate.putdata(rates)
+        rate = rate.resize(sprite.size, resample=Image.BILINEAR)
+
+    red, green, blue, alpha = sprite.split()
+    source = Image.merge('RGB', (red, green, blue))
+    if color_blend['type'] == SSBlendType.mul:
+        blended = ImageChops.multiply(source, color)
+    elif color_blend['type'] == SSBlendType.add:
+        blended = ImageChops.add(source, color)
+    elif color_blend['type'] == SSBlendType.sub:
+        blended = ImageChops.subtract(source, color)
+    else:
+        blended = color
+    blended = Image.composite(blended, source, rate)
+    blended.putalpha(alpha)
+    return blended
 
 
 class SSFrameDecoder:
-    def __init__(self, ssbp, export_path):
+    # The parsed SSBP is only read, never modified, and every cache is guarded by a lock,
+    # so one decoder can serve any number of render threads at once
+    def __init__(self, ssbp, export_path, texture_profile='fast', frame_cache_size=256, texture_cache=None,
+                 cell_index=None, transformed_cache_size=1024):
         self.ssbp = ssbp
         self.cell_maps = ssbp.cell_maps
-        #self.animation_packages = ssbp.animation_packages
+        # Packages and animations keyed by name, on shallow copies of the package dictionaries
         self.animation_packages = {}
         for animation_package in ssbp.animation_packages:
-            animations = {}
-            for animation in animation_package['animations']['data']:
-                animations[animation['name']] = animation
-            animation_package['animations'] = animations
-            self.animation_packages[animation_package['name']] = animation_package
+            animations = {animation['name']: animation for animation in animation_package['animations']['data']}
+            self.animation_packages[animation_package['name']] = dict(animation_package, animations=animations)
 
         self.cells = []
         for cell_map in [ssbp.cell_maps[key]['cells'] for key in ssbp.cell_maps]:
             self.cells.extend(cell_map)
 
+        # Cells and parts are the same in every frame, wrap them once and share them between frames
+        self.cell_objects = [SSCell().from_dict(cell) for cell in self.cells]
+        self.part_objects = {}
+        for package_name, animation_package in self.animation_packages.items():
+            parts = {}
+            for part_data in animation_package['animation parts']['data']:
+                part = SSAnimationPart().from_dict(part_data)
+                parts[part.index] = part
+            for part in parts.values():
+                part.parent = parts.get(part.parent_index)
+            self.part_objects[package_name] = parts
+
         self.export_path = export_path
+        self.texture_profile = texture_profile
+
+        # Cells split with an index are cropped out of the atlases instead of read from separate files,
+        # the index can also be passed directly, see split_cell.cell_index
+        self.texture_cache = texture_cache
+        self.cell_index = cell_index
+        self.atlases = {}  # (path, mip level): atlas
+        self.mip_sprites = {}  # (cell name, mip level): sprite, for cells split into separate files
+        index_path = os.path.join(export_path, 'tex', INDEX_NAME)
+        if cell_index is None and os.path.exists(index_path):
+            with open(index_path) as file:
+                self.cell_index = json.load(file)['cells']
+
+        # Cells split into a sprite store are loaded by the hash of their pixels, decoded and transformed
+        # sprites are then cached in the store and shared with the decoders of every other unit
+        self.sprite_store, self.cell_hashes = None, None
+        if self.cell_index is None:
+            self.sprite_store, self.cell_hashes = load_mapping(os.path.join(export_path, 'tex')) or (None, None)
+
+        # Flipped, scaled, rotated and color blended sprites, keyed by the sprite and the transformation
+        self.transformed_sprites = self.sprite_store.transformed if self.sprite_store \
+            else LRUCache(transformed_cache_size)
+
+        # Rendered frames of instanced animations, keyed by (package, animation, local time, scale, resample)
+        self.instance_cache = {}
+
+        # Resolved part states with matrices, keyed by (package, animation, time)
+        self.frame_cache = OrderedDict()
+        self.frame_cache_size = frame_cache_size
+
+        # Frame and animation bounds relative to the animation origin, keyed by (package, animation, time),
+        # time is None for the bounds of the whole animation
+        self.bounds_cache = {}
+
+        # User data event indices, keyed by (package, animation)
+        self.user_data_indices = {}
+
+        self._lock = threading.Lock()
+
+    def _cached(self, cache, key, build):
+        # Values are built outside of the lock, so slow builds don't block other threads,
+        # if two threads build the same value the first one stored is kept
+        with self._lock:
+            if key in cache:
+                return cache[key]
+        value = build()
+        with self._lock:
+            return cache.setdefault(key, value)
 
     def join_frame_data(self, animation, time):
+        # Frame data only stores the values that differ from the initial data,
+        # apply it over a copy of the initial data to get the full state of each part
         frame_data = {}
+        for part_index in animation['initial frame data']['data']:
+            initial_frame = animation['initial frame data']['data'][part_index][0]
+            frame_data[initial_frame['part index']] = dict(initial_frame)
         for part_index in animation['frame data']['data']:
             frame = animation['frame data']['data'][part_index][time]
-            frame_data[frame['part index']] = frame
-        if time == 0:
-            # Apply initial data over the frame data
-            for part_index in animation['initial frame data']['data']:
-                initial_frame = animation['initial frame data']['data'][part_index][0]
-                frame_data[initial_frame['part index']].update(initial_frame)
+            frame_data[frame['part index']].update(frame)
         return frame_data
 
-    def render_frame(self, package_name, animation_name, time, debug=True, export_parts=False):
+    def resolve_frame(self, package_name, animation_name, time):
+        # Full state of every part at the time, including the world matrices.
+        # Each frame only depends on the initial data, so any frame can be resolved directly
+        key = (package_name, animation_name, time)
+        with self._lock:
+            if key in self.frame_cache:
+                self.frame_cache.move_to_end(key)
+                return self.frame_cache[key]
+
         animation_parts = self.animation_packages[package_name]['animation parts']['data']
         animation = self.animation_packages[package_name]['animations'][animation_name]
-        canvas_size = animation['canvas size']
-        canvas_scale = 1
-        canvas_size = (round(canvas_size[0] * canvas_scale), round(canvas_size[1] * canvas_scale))
-
-        canvas = Image.new('RGBA', canvas_size, (255, 255, 255, 0))
-
-        frame_data = []
-        _frame_data = self.join_frame_data(animation, time)
+        if not 0 <= time < animation['frame count']:
+            raise IndexError(f"Frame {time} is out of range, {animation_name} has {animation['frame count']} frames")
+        frame_data = self.join_frame_data(animation, time)
 
         # Calculate matrices
-        for part_index in sorted(_frame_data):
+        for part_index in sorted(frame_data):
             if part_index == 0:
                matrix = create_identity_matrix()
             else:
                parent_index = animation_parts[part_index]['parent index']
-               matrix = _frame_data[parent_index]['matrix']
+               matrix = frame_data[parent_index]['matrix']
 
             matrix = translation_matrix_m(matrix,
-                                         _frame_data[part_index]['position x'],
-                                         _frame_data[part_index]['position y'],
-                                         _frame_data[part_index]['position z'])
+                                         frame_data[part_index]['position x'],
+                                         frame_data[part_index]['position y'],
+                                         frame_data[part_index]['position z'])
             # matrix = rotation_matrix_m(matrix,
-            #                           math.radians(_frame_data[part_index]['rotation x']),
-            #                           math.radians(_frame_data[part_index]['rotation y']),
-            #                           math.radians(_frame_data[part_index]['rotation z']))
+            #                           math.radians(frame_data[part_index]['rotation x']),
+            #                           math.radians(frame_data[part_index]['rotation y']),
+            #                           math.radians(frame_data[part_index]['rotation z']))
             matrix = scale_matrix_m(matrix,
-                                   _frame_data[part_index]['scale x'],
-                                   _frame_data[part_index]['scale y'],
+                                   frame_data[part_index]['scale x'],
+                                   frame_data[part_index]['scale y'],
                                    1.0)
-            _frame_data[part_index]['matrix'] = matrix
+            frame_data[part_index]['matrix'] = matrix
+
+        if self.frame_cache_size:
+            with self._lock:
+                self.frame_cache[key] = frame_data
+                if len(self.frame_cache) > self.frame_cache_size:
+                    self.frame_cache.popitem(last=False)
+        return frame_data
+
+    def label_time(self, package_name, animation_name, label):
+        # Time of the label in the animation's label data
+        labels = self.animation_packages[package_name]['animations'][animation_name]['label data']['data']
+        if label not in labels:
+            raise KeyError(f"{package_name}/{animation_name} has no label '{label}'")
+        return labels[label]
+
+    def user_data_index(self, package_name, animation_name):
+        animation = self.animation_packages[package_name]['animations'][animation_name]
+        return self._cached(self.user_data_indices, (package_name, animation_name),
+                            lambda: SSUserDataIndex(animation['user data']['data']))
+
+    def events(self, package_name, animation_name, start, end, part_index=None):
+        # User data events in frames [start, end) as (frame, event) pairs
+        return self.user_data_index(package_name, animation_name).events(start, end, part_index)
+
+    def render_label(self, package_name, animation_name, label, offset=0, **kwargs):
+        # Render the frame at the label, offset by the amount of frames
+        time = self.label_time(package_name, animation_name, label) + offset
+        return self.render_frame(package_name, animation_name, time, **kwargs)
+
+    def sprite_key(self, cell, level=0):
+        # Identifies the pixels of the cell's sprite, by content hash for cells in a sprite store
+        if self.cell_hashes is not None and cell.name in self.cell_hashes:
+            return self.cell_hashes[cell.name], level
+        return cell.name, level
+
+    def load_sprite(self, cell, level=0):
+        # Sprite of the cell at the mip level, 1/2**level of the size
+        if self.cell_hashes is not None:
+            if cell.name not in self.cell_hashes:
+                raise FileNotFoundError(f"{cell.name} isn't in the sprite store mapping")
+            return self.sprite_store.get(self.cell_hashes[cell.name], level)
+
+        if self.cell_index is None:
+            if not level:
+                return load_image(output_path(
+                    os.path.join(self.export_path, f"tex/{cell.name}.png"), self.texture_profile))
+            # Split cells have no atlas to take the mip level from, reduce the cell once and keep it
+            return self._cached(self.mip_sprites, (cell.name, level),
+                                lambda: mip_level(self.load_sprite(cell), level))
+
+        if cell.name not in self.cell_index:
+            raise FileNotFoundError(f"{cell.name} isn't in the cell index")
+        entry = self.cell_index[cell.name]
+        x, y, width, height = entry['rect']
+        factor = 2 ** level
+        return self.atlas(entry['texture'], level).crop(
+            (x // factor, y // factor, -(-(x + width) // factor), -(-(y + height) // factor)))
+
+    def atlas(self, path, level=0):
+        def build():
+            if self.texture_cache:
+                return self.texture_cache.get(path, level)
+            if level:
+                return mip_level(self.atlas(path, level - 1), 1)
+            with Image.open(path) as image:
+                return image.copy()
+        return self._cached(self.atlases, (path, level), build)
+
+    def clear_sprites(self):
+        # Forget the loaded textures and everything rendered from them, e.g. after the textures changed on disk.
+        # Resolved frames and bounds don't depend on the textures and are kept
+        with self._lock:
+            self.atlases.clear()
+            self.mip_sprites.clear()
+            self.instance_cache.clear()
+        if not self.sprite_store:
+            self.transformed_sprites.clear()
+
+    def transformed_sprite(self, state, level, scale, resample, rotate_resample):
+        # The part's sprite after color blending, flips, scaling and rotation. Parts drawn the same way
+        # in other frames, or with a sprite store in other units, share the result, so it must not be modified
+        flip_h = bool(state.flph or state.sclx < 0)
+        flip_v = bool(state.flpv or state.scly < 0)
+        size = self.sprite_size(state, scale)
+        angle = round(state.rotz + state._rotz)
+        center = self.rotation_center(state, scale) if angle else None
+        color_blend = None
+        if state.colb:
+            color_blend = (state.colb['type'], state.colb['single'],
+                           tuple(color and (color['rate'], tuple(color['rgba'])) for color in state.colb['colors']))
+        key = self.sprite_key(state.cell, level) + (color_blend, flip_h, flip_v, size, angle, center, resample,
+                                                    rotate_resample)
+        part_sprite = self.transformed_sprites.get(key)
+        if part_sprite is not None:
+            return part_sprite
+
+        # Open the part sprite
+        part_sprite = self.load_sprite(state.cell, level)
+        if state.colb:
+            part_sprite = apply_color_blend(part_sprite, state.colb)
+        if flip_h:
+            part_sprite = part_sprite.transpose(Image.FLIP_LEFT_RIGHT)
+        if flip_v:
+            part_sprite = part_sprite.transpose(Image.FLIP_TOP_BOTTOM)
+        if size != part_sprite.size:
+            part_sprite = part_sprite.resize(size, resample=resample)
+        if angle:
+            part_sprite = part_sprite.rotate(
+                angle=angle,
+                resample=rotate_resample,
+                expand=True,
+                center=center
+            )
+        if part_sprite.mode != 'RGBA':
+            part_sprite = part_sprite.convert('RGBA')
+        self.transformed_sprites.put(key, part_sprite)
+        return part_sprite
+
+    def instanced_animation(self, package_name, instance_name):
+        # Package and animation names an instance part of the package refers to, instance name is in
+        # "package/animation" format, or just "animation" for animations of the same package.
+        # Returns (package name, animation name, animation), None if the animation doesn't exist
+        if '/' in instance_name:
+            instance_package, instance_animation = instance_name.split('/', 1)
+        else:
+            instance_package, instance_animation = package_name, instance_name
+        animation = self.animation_packages.get(instance_package, {}).get('animations', {}).get(instance_animation)
+        if animation is None:
+            return None
+        return instance_package, instance_animation, animation
+
+    def instance_target(self, package_name, state, time, ancestors=()):
+        # Animation referenced by the instance part and its local time, returns None if there's nothing to show.
+        # Ancestors are the (package, animation) pairs being rendered or measured around the part
+        instance_name = state.part.animation_instance_name
+        if not instance_name:
+            return None
+        instanced = self.instanced_animation(package_name, instance_name)
+        if instanced is None:
+            print(f"! Instanced animation {instance_name} wasn't found, skipping", file=sys.stderr)
+            return None
+        instance_package, instance_animation, animation = instanced
+
+        local_time = state.instance.local_time(time, animation['frame count'])
+        if local_time is None:
+            return None
+        if (instance_package, instance_animation) in ancestors:
+            print(f"! Instanced animation {instance_name} references itself, skipping", file=sys.stderr)
+            return None
+        return instance_package, instance_animation, local_time
+
+    def render_instance(self, package_name, state, time, quality='full', ancestors=()):
+        # Render the animation referenced by the instance part at the mapped local time,
+        # the rendered frames are shared, so they must not be modified
+        target = self.instance_target(package_name, state, time, ancestors)
+        if target is None:
+            return None
+        instance_package, instance_animation, local_time = target
+        return self._cached(self.instance_cache, target + render_quality(quality), lambda: self.render_frame(
+            instance_package, instance_animation, local_time, debug=False, canvas='frame', quality=quality,
+            ancestors=ancestors))
+
+    def frame_states(self, package_name, animation_name, time):
+        # Wrap the resolved frame into part states linked to their parents, cells and parts
+        parts = self.part_objects[package_name]
+        frame_data = []
+        _frame_data = self.resolve_frame(package_name, animation_name, time)
 
         # Wrap data
         for part_index in _frame_data:
             # Wrap frame data into SSPartState
             part_state = SSPartState(part_index).from_dict(_frame_data[part_index])
-            # Wrap part data into SSAnimationPart
-            part_state.part = SSAnimationPart().from_dict(animation_parts[part_state.part])
+            part_state.part = parts[part_state.part]
+            if part_state.part.type == SSPartType.instance and not part_state.instance:
+                part_state.instance = AnimationInstance()
             if _frame_data[part_index]['cell index'] != -1:
-                # Wrap cell data into SSCell
-                cell_data = self.cells[_frame_data[part_index]['cell index']]
-                part_state.cell = SSCell().from_dict(cell_data)
+                part_state.cell = self.cell_objects[_frame_data[part_index]['cell index']]
             else:
                 part_state.cell = None
             part_state.matrix = _frame_data[part_index]['matrix']
             frame_data.append(part_state)
 
+        states = {state.part.index: state for state in frame_data}
         for state in frame_data:
             # Find parents
-            for _part_state in frame_data:
-                if _part_state.part.index == state.part.parent_index:
-                    state.parent = _part_state
-                    state.part.parent = _part_state.part
+            state.parent = states.get(state.part.parent_index)
 
             # Default to cell map pivot
             if state.cell:
@@ -141,18 +488,15 @@ class SSFrameDecoder:
                 state._rotz += parent.rotz
 
             # Update vertices
-            pivot = SSVector2(0, 0)
             if state.cell:
                 cpx = state.cell.pivot.x + 0.5
                 if state.flph: cpx = 1 - cpx
-                pivot.x = cpx * state.sizx
 
                 cpy = -state.cell.pivot.y + 0.5
                 if state.flpv: cpy = 1 - cpy
-                pivot.y = cpy * state.sizy
+                pivot = SSVector2(cpx * state.sizx, cpy * state.sizy)
             else:
-                pivot.x = 0.5 * state.sizx
-                pivot.y = 0.5 * state.sizy
+                pivot = SSVector2(0.5 * state.sizx, 0.5 * state.sizy)
 
             sx = -pivot.x
             ex = sx + state.sizx
@@ -170,76 +514,221 @@ class SSFrameDecoder:
                     state.vertices[i * 3 + 0] = vtxPosX[i] + vtxOfs.x
                     state.vertices[i * 3 + 1] = vtxPosY[i] + vtxOfs.y
                     state.vertices[i * 3 + 2] = 0
-                    vtxOfs += 1
+                    vtxOfs = vtxOfs + 1
+        return frame_data
+
+    @staticmethod
+    def sprite_size(state, scale=1):
+        # Size of a cell part's sprite after scaling, before rotation
+        if abs(state.sclx) != 1.0 or abs(state.scly) != 1.0:
+            width, height = abs(state.sclx) * state.sizx, abs(state.scly) * state.sizy
+        else:
+            width, height = state.cell.size.x, state.cell.size.y
+        return max(round(width * scale), 1), max(round(height * scale), 1)
+
+    def sprite_rect(self, state, origin, scale=1):
+        # Position and size of a cell part's sprite on the canvas after scaling and rotation,
+        # computed without touching the sprite. Origin is the canvas position of the animation origin
+        size = self.sprite_size(state, scale)
+        if state.rotz + state._rotz:
+            size = rotated_size(size, round(state.rotz + state._rotz), center=self.rotation_center(state, scale))
+
+        absx = origin[0] + state.matrix[12] * scale  # x
+        absy = origin[1] - state.matrix[13] * scale  # y
+        absx -= (state.pvtx * state.sizx) * scale  # pivot
+        absy -= (state.pvty * state.sizy) * scale  # offset
+        absx -= size[0] / 2  # offset for dimension changes after sprite manipulation
+        absy -= size[1] / 2  # e.g., canvas expansion after rotation
+        return round(absx), round(absy), size[0], size[1]
+
+    @staticmethod
+    def rotation_center(state, scale=1):
+        return (
+            round(((state.sizx / 2) - state.cell.pivot.x * state.sizx) * scale),
+            round(((state.sizy / 2) + state.cell.pivot.y * state.sizy) * scale)
+        )
+
+    def instance_placement(self, package_name, state, time, origin, scale=1, ancestors=()):
+        # Canvas position and size of the instance part's transformed canvas, and the bounds of its content,
+        # returns None if the instance shows nothing
+        key = self.instance_target(package_name, state, time, ancestors)
+        if key is None:
+            return None
+        instance_package, instance_animation, local_time = key
+        content = self.frame_bounds(instance_package, instance_animation, local_time, ancestors)
+        if content is None:
+            return None
+        # Same layout as render_instance, a canvas fitted to the instanced frame
+        instance_canvas_size, instance_origin = self.canvas_layout(instance_package, instance_animation, 'frame',
+                                                                   scale, local_time, ancestors)
+
+        # Follow the instance origin and content corners through the flips, scaling and rotation of the canvas
+        x0, y0, x1, y1 = (value * scale for value in content)
+        points = [instance_origin] + [(instance_origin[0] + x, instance_origin[1] + y)
+                                      for x, y in ((x0, y0), (x1, y0), (x0, y1), (x1, y1))]
+        points, size = transform_points(points, instance_canvas_size, state)
+        (origin_x, origin_y), corners = points[0], points[1:]
+        dest = (round(origin[0] + state.matrix[12] * scale - origin_x),
+                round(origin[1] - state.matrix[13] * scale - origin_y))
+        bounds = (
+            dest[0] + min(x for x, _ in corners), dest[1] + min(y for _, y in corners),
+            dest[0] + max(x for x, _ in corners), dest[1] + max(y for _, y in corners)
+        )
+        return dest, size, bounds
+
+    def part_bounds(self, package_name, state, time, origin=(0, 0), ancestors=()):
+        # Canvas space AABB of the part as (left, top, right, bottom), None for parts that draw nothing
+        if state.hide:
+            return None
+        if state.instance:
+            placement = self.instance_placement(package_name, state, time, origin, ancestors=ancestors)
+            return placement[2] if placement else None
+        if not state.cell:
+            return None
+        x, y, width, height = self.sprite_rect(state, origin)
+        return x, y, x + width, y + height
+
+    def frame_bounds(self, package_name, animation_name, time, ancestors=()):
+        # AABB of everything drawn in the frame, relative to the animation origin, None for empty frames
+        def build():
+            bounds = None
+            part_ancestors = ancestors + ((package_name, animation_name),)
+            for state in self.frame_states(package_name, animation_name, time):
+                bounds = union_bounds(bounds, self.part_bounds(package_name, state, time, ancestors=part_ancestors))
+            return bounds
+        return self._cached(self.bounds_cache, (package_name, animation_name, time), build)
+
+    def animation_bounds(self, package_name, animation_name):
+        # AABB of every frame of the animation relative to its origin, the minimal canvas for the animation
+        def build():
+            bounds = None
+            animation = self.animation_packages[package_name]['animations'][animation_name]
+            for time in range(animation['frame count']):
+                bounds = union_bounds(bounds, self.frame_bounds(package_name, animation_name, time))
+            return bounds
+        return self._cached(self.bounds_cache, (package_name, animation_name, None), build)
+
+    def canvas_layout(self, package_name, animation_name, canvas=None, scale=1, time=None, ancestors=()):
+        # Canvas size and the canvas position of the animation origin, either the authored canvas,
+        # with canvas='auto' the smallest canvas that fits every frame of the animation, or with canvas='frame'
+        # a canvas that fits the frame at time, which instanced animations are rendered on so nothing is clipped
+        if canvas == 'auto':
+            bounds = self.animation_bounds(package_name, animation_name)
+            if bounds:
+                size = (math.ceil((bounds[2] - bounds[0]) * scale), math.ceil((bounds[3] - bounds[1]) * scale))
+                return (max(size[0], 1), max(size[1], 1)), (-bounds[0] * scale, -bounds[1] * scale)
+        if canvas == 'frame':
+            bounds = self.frame_bounds(package_name, animation_name, time, ancestors)
+            if bounds:
+                # Parts are placed with rounding at the render scale, a pixel of margin keeps them inside
+                size = (math.ceil((bounds[2] - bounds[0]) * scale) + 2, math.ceil((bounds[3] - bounds[1]) * scale) + 2)
+                return size, (1 - bounds[0] * scale, 1 - bounds[1] * scale)
+        canvas_size = self.animation_packages[package_name]['animations'][animation_name]['canvas size']
+        origin = (canvas_size[0] / 2 * scale, (canvas_size[1] / 2 + ORIGIN_OFFSET_Y) * scale)
+        return (max(round(canvas_size[0] * scale), 1), max(round(canvas_size[1] * scale), 1)), origin
+
+    def render_frame(self, package_name, animation_name, time, debug=True, export_parts=False, canvas=None,
+                     quality='full', layers=None, ancestors=()):
+        # Everything a render changes is local to the call, the returned canvas belongs to the caller.
+        # If a list is passed as layers, every drawn part is appended to it as a cropped layer,
+        # export_parts writes those layers to <package>-<animation>-<time>.layers.json in the export path
+        if export_parts and layers is None:
+            layers = []
+        ancestors = ancestors + ((package_name, animation_name),)
+        scale, resample = render_quality(quality)
+        # Pillow only rotates with nearest, bilinear and bicubic filters
+        rotate_resample = resample if resample in (Image.NEAREST, Image.BILINEAR, Image.BICUBIC) else Image.BICUBIC
+        level = mip_level_for(scale)
+        canvas_size, origin = self.canvas_layout(package_name, animation_name, canvas, scale, time, ancestors[:-1])
+        canvas_rect = (0, 0) + canvas_size
+
+        canvas = Image.new('RGBA', canvas_size, (255, 255, 255, 0))
+
+        frame_data = self.frame_states(package_name, animation_name, time)
 
         for state in frame_data:
-            if state.instance:
-                print('! Animation instances are not implemented')
             if state.vertex:
-                print('! Vertex transformation is not implemented')
-            if state.hide or not state.cell:
+                print('! Vertex transformation is not implemented', file=sys.stderr)
+            if state.hide:
+                continue
+
+            if state.instance:
+                placement = self.instance_placement(package_name, state, time, origin, scale, ancestors)
+                # Skip instances that end up outside of the canvas before rendering them
+                if placement is None or not intersects(placement[2], canvas_rect):
+                    continue
+                part_sprite = self.render_instance(package_name, state, time, quality, ancestors)
+                if part_sprite is None:
+                    continue
+
+                if state.flph or state.sclx < 0:
+                    part_sprite = part_sprite.transpose(Image.FLIP_LEFT_RIGHT)
+                if state.flpv or state.scly < 0:
+                    part_sprite = part_sprite.transpose(Image.FLIP_TOP_BOTTOM)
+                if abs(state.sclx) != 1.0 or abs(state.scly) != 1.0:
+                    part_sprite = part_sprite.resize(
+                        (max(round(abs(state.sclx) * part_sprite.size[0]), 1),
+                         max(round(abs(state.scly) * part_sprite.size[1]), 1)),
+                        resample=resample
+                    )
+                if state.rotz + state._rotz:
+                    part_sprite = part_sprite.rotate(
+                        angle=round(state.rotz + state._rotz),
+                        resample=rotate_resample,
+                        expand=True
+                    )
+
+                if debug:
+                    print(f"- Instance {state.part.animation_instance_name} | Matrix {state.matrix[12:-2]}")
+                    print(f"- {state}")
+                self.composite_part(canvas, part_sprite, placement[0], state, layers)
+                continue
+
+            if not state.cell:
+                continue
+
+            # Skip parts that end up outside of the canvas before loading their sprite
+            absx, absy, width, height = self.sprite_rect(state, origin, scale)
+            if not intersects((absx, absy, absx + width, absy + height), canvas_rect):
                 continue
 
             try:
-                # Open the part sprite
-                part_sprite = Image.open(
-                    os.path.join(self.export_path, f"tex/{state.cell.name}.png"))
+                part_sprite = self.transformed_sprite(state, level, scale, resample, rotate_resample)
             except FileNotFoundError:
-                print(f"! {unit}/tex/{state.cell.name}.png wasn't found, skipping")
+                print(f"! {self.export_path}/tex/{state.cell.name} wasn't found, skipping", file=sys.stderr)
                 continue
 
-            if state.flph or state.sclx < 0:
-                part_sprite = part_sprite.transpose(Image.FLIP_LEFT_RIGHT)
-                # state.pvty = -state.pvty
-            if state.flpv or state.scly < 0:
-                part_sprite = part_sprite.transpose(Image.FLIP_TOP_BOTTOM)
-                # state.pvtx = -state.pvtx
-            if abs(state.sclx) != 1.0 or abs(state.scly) != 1.0:
-                part_sprite = part_sprite.resize(
-                    (round(abs(state.sclx) * state.sizx),
-                     round(abs(state.scly) * state.sizy)),
-                    resample=Image.BICUBIC
-                )
-            if state.rotz + state._rotz:
-                part_sprite = part_sprite.rotate(
-                    angle=round(state.rotz + state._rotz),
-                    resample=Image.BICUBIC,
-                    expand=True,
-                    center=(
-                        round((state.sizx / 2) - state.cell.pivot.x * state.sizx),
-                        round((state.sizy / 2) + state.cell.pivot.y * state.sizy)
-                    )
-                )
-
-            absx = (canvas_size[0] - state.sizx) / 2  # center the part
-            absy = (canvas_size[1] - state.sizy) / 2  # at canvas center
-            absx += state.matrix[12]  # x
-            absy -= state.matrix[13]  # y
-            absx -= (state.pvtx * state.sizx)  # pivot
-            absy -= (state.pvty * state.sizy)  # offset
-            absx += (state.sizx - part_sprite.size[0]) / 2  # offset for dimension changes after sprite manipulation
-            absy += (state.sizy - part_sprite.size[1]) / 2  # e.g., canvas expansion after rotation
-
-            absx = round(absx)
-            absy = round(absy + 95)
             if debug:
                 print(f"- Parent rotation {state._rotz:.2f} | Pivot offset ({round(state.pvtx * state.sizx)}, {round(state.pvty * state.sizy)}) | Matrix {state.matrix[12:-2]} | Vertices {state.vertices[:-3]}")
                 print(f"- {state}")
                 for parent in state:
                     print(f"| {parent}")
 
-            canvas.alpha_composite(part_sprite, dest=(absx, absy))
-            if export_parts:
-                part_canvas = Image.new('RGBA', canvas_size, (255, 255, 255, 0))
-                part_canvas.alpha_composite(part_sprite, dest=(absx, absy))
-                part_canvas.save(
-                    os.path.join(
-                        self.export_path,
-                        f"{animation_name}-{time}-{state.part.index}-{state.part.name}.png"
-                    )
-                )
+            self.composite_part(canvas, part_sprite, (absx, absy), state, layers)
+
+        if export_parts:
+            save_layers(layers, canvas.size, os.path.join(self.export_path, f"{package_name}-{animation_name}-{time}"))
         return canvas
 
+    @staticmethod
+    def composite_part(canvas, part_sprite, dest, state, layers=None):
+        composite(canvas, part_sprite, dest)
+        if layers is None:
+            return
+        layer = crop_layer(part_sprite, dest, canvas.size)
+        if layer is None:
+            return
+        image, offset = layer
+        layers.append({
+            'name': state.part.name,
+            'part index': state.part.index,
+            'z': len(layers),
+            'image': image,
+            'offset': offset,
+            'blend': state.part.alpha_blend_type.name,
+            'color blend': state.colb['type'].name if state.colb and not state.instance else None,
+            'instance': state.part.animation_instance_name if state.instance else None
+        })
 
 if __name__ == "__main__":
     unit = 'ch04_12_Tiki_F_Normal'
@@ -247,15 +736,12 @@ if __name__ == "__main__":
     with open(f'data/Unit/{unit}/{unit}.ssbp', 'rb') as file:
         ssbp = SSBP(file, debug=False, dump_initial_frames=False, dump_frames=False)
 
-        for path in ['output', f'output/{unit}', f'output/{unit}/tex']:
-            if not os.path.exists(path):
-                os.mkdir(path)
-
-        if ssbp.cells_count / 1.2 > len([name for name in os.listdir(f'output/{unit}/tex') if not os.path.isdir(name)]):
-            print(f'Splitting the {unit} cell map')
-            split_cellmap(unit, ssbp)
+        manifest = Manifest(f'output/{unit}/manifest.json')
+        if update_cellmap(unit, ssbp, manifest):
+            print(f'Split the {unit} cell map')
+        manifest.save()
 
         fd = SSFrameDecoder(ssbp, export_path=f'output/{unit}')
         sprite = fd.render_frame('body_anim', 'Idle', 0)
-        sprite.save(f'output/{unit}/body_anim-Idle-0.png')
+        save_image(sprite, f'output/{unit}/body_anim-Idle-0.png', 'compact')
         # sprite.show()
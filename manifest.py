@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+from ssbp import __version__
+
+
+MANIFEST_VERSION = 1
+
+
+class Manifest:
+    # Records the hashes of the inputs every output artifact was built from,
+    # so re-runs only rebuild the artifacts whose inputs changed.
+    # Artifact names are paths relative to the folder of the manifest
+    # Usage example:
+    # manifest = Manifest('output/ch04_12_Tiki_F_Normal/manifest.json')
+    # if not manifest.is_up_to_date('body_anim-Idle-0.png', inputs):
+    #     ...
+    #     manifest.record('body_anim-Idle-0.png', inputs)
+    # manifest.save()
+    def __init__(self, path):
+        self.path = path
+        self.root = os.path.dirname(path)
+        self.artifacts = {}
+        self.sources = {}  # path: [mtime, size, hash], so unchanged files aren't hashed again
+        if os.path.exists(path):
+            with open(path) as file:
+                data = json.load(file)
+            if data.get('manifest version') == MANIFEST_VERSION:
+                self.artifacts = data['artifacts']
+                self.sources = data['sources']
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = self.sources.get(key)
+        if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            return cached[2]
+        with open(path, 'rb') as file:
+            file_hash = hashlib.sha1(file.read()).hexdigest()
+        self.sources[key] = [stat.st_mtime, stat.st_size, file_hash]
+        return file_hash
+
+    def folder_hashes(self, path):
+        # Hashes of every file in the folder, e.g. the .ssbp and the textures of a unit
+        return {name: self.file_hash(os.path.join(path, name)) for name in sorted(os.listdir(path))
+                if os.path.isfile(os.path.join(path, name))}
+
+    @staticmethod
+    def key(inputs):
+        # Inputs are combined with the tool version, so a new version rebuilds everything
+        inputs = dict(inputs, **{'tool version': __version__})
+        encoded = json.dumps(inputs, sort_keys=True, default=repr)
+        return hashlib.sha1(encoded.encode()).hexdigest()
+
+    def is_up_to_date(self, artifact, inputs, check_exists=True):
+        if self.artifacts.get(artifact) != self.key(inputs):
+            return False
+        return not check_exists or os.path.exists(os.path.join(self.root, artifact))
+
+    def record(self, artifact, inputs):
+        self.artifacts[artifact] = self.key(inputs)
+
+    def forget(self, artifact):
+        self.artifacts.pop(artifact, None)
+
+    def save(self):
+        os.makedirs(self.root or '.', exist_ok=True)
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({
+                'manifest version': MANIFEST_VERSION,
+                'artifacts': self.artifacts,
+                'sources': self.sources
+            }, file, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.path)
+
+
+def frame_inputs(decoder, package_name, animation_name, time):
+    # Resolved state of every part in the frame, the cells it uses, plus the data of the animations
+    # it instances, a frame only needs to be rendered again if this changes
+    frame = decoder.resolve_frame(package_name, animation_name, time)
+    inputs = {
+        'frame': [sorted(frame[part_index].items()) for part_index in sorted(frame)],
+        'cells': [decoder.cells[frame[part_index]['cell index']] for part_index in sorted(frame)
+                  if frame[part_index]['cell index'] != -1]
+    }
+    for part in decoder.animation_packages[package_name]['animation parts']['data']:
+        instance_name = part['animation instance name']
+        instanced = instance_name and decoder.instanced_animation(package_name, instance_name)
+        if instanced:
+            animation = instanced[2]
+            inputs[instance_name] = [animation['initial frame data']['data'], animation['frame data']['data']]
+            inputs['cells'] = decoder.cells
+    return inputs
+
+
+def render_inputs(decoder, package_name, animation_name, time, textures, profile, canvas=None, quality='full'):
+    # Everything a rendered frame depends on, textures are the hashes from texture_inputs
+    inputs = dict(frame_inputs(decoder, package_name, animation_name, time),
+                  textures=textures, profile=profile, canvas=canvas, quality=quality)
+    if canvas == 'auto':
+        # The auto canvas fits every frame, so it changes with the rest of the animation
+        inputs['animation bounds'] = decoder.animation_bounds(package_name, animation_name)
+    return inputs
+
+
+def texture_inputs(manifest, ssbp, data_path, unit):
+    # Hashes of the textures used by the cell maps
+    textures = {}
+    for cell_map in ssbp.cell_maps.values():
+        path = os.path.join(data_path, unit, cell_map['image path'])
+        textures[cell_map['image path']] = manifest.file_hash(path) if os.path.exists(path) else None
+    return textures
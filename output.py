@@ -0,0 +1,168 @@
+import io
+import itertools
+import os
+import queue
+import struct
+import threading
+from PIL import Image
+
+
+# Encode profiles, 'fast' is meant for intermediate artifacts and 'compact' for the final output
+ENCODE_PROFILES = {
+    'fast': {'format': 'PNG', 'extension': 'png', 'options': {'compress_level': 1, 'optimize': False}},
+    'compact': {'format': 'PNG', 'extension': 'png', 'options': {'compress_level': 9, 'optimize': True}},
+    'webp': {'format': 'WEBP', 'extension': 'webp', 'options': {'lossless': True, 'method': 4}},
+    # Uncompressed RGBA behind a small header, see save_raw
+    'raw': {'format': 'RAW', 'extension': 'rgba', 'options': {}},
+}
+
+RAW_MAGIC = b'RGBA'
+RAW_HEADER = struct.Struct('<4sII')  # magic, width, height
+
+_temporary_names = itertools.count()
+
+
+def output_path(path, profile):
+    # Swap the extension of the path for the one used by the profile
+    return f"{os.path.splitext(path)[0]}.{ENCODE_PROFILES[profile]['extension']}"
+
+
+def save_raw(image, path):
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    with open(path, 'wb') as file:
+        file.write(RAW_HEADER.pack(RAW_MAGIC, image.size[0], image.size[1]))
+        file.write(image.tobytes())
+
+
+def load_raw(path):
+    with open(path, 'rb') as file:
+        magic, width, height = RAW_HEADER.unpack(file.read(RAW_HEADER.size))
+        if magic != RAW_MAGIC:
+            raise ValueError(f'{path} is not a raw RGBA file')
+        return Image.frombytes('RGBA', (width, height), file.read(width * height * 4))
+
+
+def save_image(image, path, profile='compact'):
+    # Save the image with the encode profile, returns the path it was written to.
+    # The image is written next to the path and renamed over it, so readers never see a half written file
+    # and a path hardlinked to another file gets a new file instead of overwriting both
+    settings = ENCODE_PROFILES[profile]
+    path = output_path(path, profile)
+    temporary_path = f'{path}.{os.getpid()}.{next(_temporary_names)}.tmp'
+    try:
+        if settings['format'] == 'RAW':
+            save_raw(image, temporary_path)
+        else:
+            image.save(temporary_path, format=settings['format'], **settings['options'])
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return path
+
+
+def encode_image(image, profile='fast'):
+    # Encode the image with the profile in memory, returns the bytes
+    settings = ENCODE_PROFILES[profile]
+    if settings['format'] == 'RAW':
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        return RAW_HEADER.pack(RAW_MAGIC, image.size[0], image.size[1]) + image.tobytes()
+    buffer = io.BytesIO()
+    image.save(buffer, format=settings['format'], **settings['options'])
+    return buffer.getvalue()
+
+
+def load_image(path):
+    # Decoded right away, so the file is closed and the image can be shared between threads
+    if path.endswith('.' + ENCODE_PROFILES['raw']['extension']):
+        return load_raw(path)
+    with Image.open(path) as image:
+        return image.copy()
+
+
+def fsync_paths(paths):
+    # Flush the written files and their directories to disk
+    directories = set()
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(path) or '.')
+    if os.name == 'posix':
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class ImageWriter:
+    # Encodes and saves images on background threads, fsyncing written files in batches
+    # Usage example:
+    # with ImageWriter(profile='fast') as writer:
+    #     writer.save(image, 'output/image.png')
+    def __init__(self, profile='compact', workers=2, queue_size=32, fsync_every=0):
+        self.profile = profile
+        self.fsync_every = fsync_every
+        self.errors = []
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._written = []
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._worker, name='image-writer', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                image, path, profile = item
+                path = save_image(image, path, profile)
+                if self.fsync_every:
+                    with self._lock:
+                        self._written.append(path)
+                        if len(self._written) >= self.fsync_every:
+                            batch, self._written = self._written, []
+                        else:
+                            batch = None
+                    if batch:
+                        fsync_paths(batch)
+            except Exception as error:
+                with self._lock:
+                    self.errors.append((item[1], error))
+            finally:
+                self._queue.task_done()
+
+    def save(self, image, path, profile=None):
+        # Queue the image, blocks if the writer is behind
+        self._queue.put((image, path, profile or self.profile))
+
+    def flush(self):
+        # Wait for the queued images to be written and sync the remaining batch
+        self._queue.join()
+        with self._lock:
+            batch, self._written = self._written, []
+        if batch:
+            fsync_paths(batch)
+
+    def close(self):
+        self.flush()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
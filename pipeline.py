@@ -0,0 +1,203 @@
+import fnmatch
+import io
+import os
+import queue
+import sys
+import threading
+from ssbp import SSBP
+from split_cell import update_cellmap
+from manifest import Manifest, render_inputs, texture_inputs
+from frame_decoder import SSFrameDecoder
+from export_layers import save_layers
+from output import output_path as encoded_path, save_image
+from texture_cache import TextureCache
+
+
+class Stage:
+    # One step of the pipeline, function takes a single item and either returns the item
+    # for the next stage, None to drop it, or a generator to fan out into several items
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+
+class _Done:
+    # Queue sentinel, one is sent for every worker of the receiving stage
+    pass
+
+
+class Pipeline:
+    # Runs the stages on their own threads, connected by bounded queues,
+    # so a slow stage blocks the producers instead of buffering everything in memory
+    def __init__(self, stages, queue_size=8):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.errors = []
+        self._errors_lock = threading.Lock()
+
+    def _worker(self, stage, input_queue, output_queue, finished):
+        while True:
+            item = input_queue.get()
+            if isinstance(item, _Done):
+                break
+            try:
+                result = stage.function(item)
+                if result is None:
+                    continue
+                if hasattr(result, '__next__'):
+                    for sub_item in result:
+                        if output_queue is not None:
+                            output_queue.put(sub_item)
+                elif output_queue is not None:
+                    output_queue.put(result)
+            except Exception as error:
+                with self._errors_lock:
+                    self.errors.append((stage.name, item, error))
+
+        # The last worker of the stage to finish closes the next queue
+        with finished['lock']:
+            finished['count'] += 1
+            last = finished['count'] == stage.workers
+        if last and output_queue is not None:
+            for _ in range(finished['next workers']):
+                output_queue.put(_Done())
+
+    def run(self, items):
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        threads = []
+        for stage_index, stage in enumerate(self.stages):
+            is_last = stage_index == len(self.stages) - 1
+            finished = {
+                'lock': threading.Lock(),
+                'count': 0,
+                'next workers': 0 if is_last else self.stages[stage_index + 1].workers
+            }
+            output_queue = None if is_last else queues[stage_index + 1]
+            for _ in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage, queues[stage_index], output_queue, finished),
+                    name=f'pipeline-{stage.name}',
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+
+        for item in items:
+            queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_Done())
+
+        for thread in threads:
+            thread.join()
+        return self.errors
+
+
+def _matches(name, patterns):
+    return not patterns or any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def out_of_date_frames(unit, decoder, manifest, textures, output_path='output', profile='compact', canvas=None,
+                       quality='full', layers=False, packages=None, animations=None, frames=None, counts=None):
+    # Frames of the unit whose output is missing or was rendered from other inputs, as items for render_stages,
+    # frames that are up to date are only counted. Packages and animations are names or globs
+    unit_output_path = os.path.join(output_path, unit)
+    for package_name, package in decoder.animation_packages.items():
+        if not _matches(package_name, packages):
+            continue
+        for animation_name, animation in package['animations'].items():
+            if not _matches(animation_name, animations):
+                continue
+            for time in range(animation['frame count']):
+                if frames is not None and time not in frames:
+                    continue
+                name = f'{package_name}-{animation_name}-{time}'
+                artifact = f'{name}.layers.json' if layers else encoded_path(name, profile)
+                inputs = render_inputs(decoder, package_name, animation_name, time, textures, profile,
+                                       canvas=canvas, quality=quality)
+                if manifest.is_up_to_date(artifact, inputs):
+                    if counts is not None:
+                        counts['skipped'] += 1
+                    continue
+                yield {'decoder': decoder, 'manifest': manifest, 'package': package_name, 'animation': animation_name,
+                       'time': time, 'path': os.path.join(unit_output_path, name), 'artifact': artifact,
+                       'inputs': inputs}
+
+
+def render_stages(profile='compact', canvas=None, quality='full', layers=False, debug=False, workers=4, counts=None):
+    # Render and encode stages for the items of out_of_date_frames, encoded frames are recorded in their manifest
+    lock = threading.Lock()
+
+    def render(item):
+        item['layers'] = [] if layers else None
+        item['image'] = item['decoder'].render_frame(item['package'], item['animation'], item['time'], debug=debug,
+                                                     canvas=canvas, quality=quality, layers=item['layers'])
+        return item
+
+    def encode(item):
+        if layers:
+            save_layers(item['layers'], item['image'].size, item['path'], profile)
+        else:
+            save_image(item['image'], item['path'], profile)
+        with lock:
+            item['manifest'].record(item['artifact'], item['inputs'])
+            if counts is not None:
+                counts['rendered'] += 1
+
+    return [Stage('render', render, workers=workers), Stage('encode', encode, workers=workers)]
+
+
+def render_units(units, data_path='data/Unit', output_path='output', profile='compact', texture_profile='fast',
+                 packages=None, animations=None, frames=None, workers=4, queue_size=8, texture_cache_path=None,
+                 quality='full', canvas=None, layers=False, index=False, store=None, force=False):
+    # Render the frames of the units that aren't up to date, overlapping file reads, parsing, texture decoding,
+    # rendering and encoding across units. Returns the errors and the counts of rendered and skipped frames
+    texture_cache = TextureCache.open(texture_cache_path) if texture_cache_path else None
+    manifests = []
+    counts = {'rendered': 0, 'skipped': 0}
+    counts_lock = threading.Lock()
+
+    def read(unit):
+        with open(os.path.join(data_path, unit, f'{unit}.ssbp'), 'rb') as file:
+            return unit, io.BytesIO(file.read())
+
+    def parse(item):
+        unit, buffer = item
+        return unit, SSBP(buffer)
+
+    def textures(item):
+        unit, ssbp = item
+        unit_output_path = os.path.join(output_path, unit)
+        manifest = Manifest(os.path.join(unit_output_path, 'manifest.json'))
+        if force:
+            manifest.artifacts.clear()
+        update_cellmap(unit, ssbp, manifest, data_path=data_path, output_path=output_path,
+                       profile=texture_profile, index=index, store=store, texture_cache=texture_cache)
+        with counts_lock:
+            manifests.append(manifest)
+
+        decoder = SSFrameDecoder(ssbp, export_path=unit_output_path, texture_profile=texture_profile,
+                                 texture_cache=texture_cache)
+        unit_counts = {'skipped': 0}
+        yield from out_of_date_frames(unit, decoder, manifest, texture_inputs(manifest, ssbp, data_path, unit),
+                                      output_path, profile, canvas, quality, layers, packages, animations, frames,
+                                      unit_counts)
+        with counts_lock:
+            counts['skipped'] += unit_counts['skipped']
+
+    pipeline = Pipeline([
+        Stage('read', read, workers=2),
+        Stage('parse', parse, workers=max(workers // 2, 1)),
+        Stage('textures', textures, workers=max(workers // 2, 1)),
+    ] + render_stages(profile, canvas, quality, layers, workers=workers, counts=counts), queue_size=queue_size)
+    errors = pipeline.run(units)
+    for manifest in manifests:
+        manifest.save()
+    return errors, counts
+
+
+if __name__ == "__main__":
+    # feh-ssbp render runs its units through this pipeline
+    from cli import main
+    sys.exit(main(['render'] + sys.argv[1:]))
@@ -0,0 +1,253 @@
+import json
+import math
+import os
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from PIL import Image
+from ssbp import SSBP
+from split_cell import cell_index
+from sprite_store import MAPPING_NAME
+from frame_decoder import RENDER_QUALITIES, SSFrameDecoder
+from output import ENCODE_PROFILES, encode_image
+from texture_cache import TextureCache
+from utility import LRUCache
+
+# Local render service, every response is JSON or an image encoded with the server's profile
+#   GET /units                                           names of the units in the data path
+#   GET /units/<unit>                                    cell and animation summary of the unit
+#   GET /units/<unit>/<package>/<animation>              animation metadata: frame count, fps, canvas size,
+#                                                        labels, user data, bounds and the sprite sheet layout
+#   GET /units/<unit>/<package>/<animation>/<time>.png   rendered frame, time is a frame or a label name
+#   GET /units/<unit>/<package>/<animation>/sheet.png    every frame of the animation in one image
+# Frames and sheets take ?quality=<name> (see frame_decoder.RENDER_QUALITIES) and ?canvas=auto.
+# The extension follows the server's encode profile, e.g. .webp for the webp profile
+
+CONTENT_TYPES = {'PNG': 'image/png', 'WEBP': 'image/webp', 'RAW': 'application/octet-stream'}
+
+
+class RenderServer:
+    # Keeps parsed units with their decoders, decoded atlases and transformed sprites in bounded LRU caches.
+    # Renders run on a worker pool, concurrent requests for the same frame wait for the same render.
+    # Units are keyed by the stamps of their files, so edited units are loaded again on the next request
+    # Usage example:
+    # server = RenderServer('data/Unit')
+    # png = server.frame('ch04_12_Tiki_F_Normal', 'body_anim', 'Idle', 0)
+    def __init__(self, data_path='data/Unit', output_path='output', profile='fast', workers=4, unit_cache_size=16,
+                 response_cache_size=512, texture_cache_path=None):
+        self.data_path = data_path
+        self.output_path = output_path
+        self.profile = profile
+        self.units = LRUCache(unit_cache_size)  # (unit, stamps): decoder
+        self.responses = LRUCache(response_cache_size)  # request key: encoded bytes
+        self.texture_cache = TextureCache(texture_cache_path) if texture_cache_path else None
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self._in_flight = {}  # key: future of the value being built
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.pool.shutdown()
+        if self.texture_cache:
+            self.texture_cache.close()
+
+    def _coalesced(self, cache, key, build, pooled=False):
+        # Return the cached value or build it, a key that's already being built isn't built twice
+        value = cache.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.pool.submit(build) if pooled else Future()
+                self._in_flight[key] = future
+        if owner and not pooled:
+            try:
+                future.set_result(build())
+            except Exception as error:
+                future.set_exception(error)
+        try:
+            value = future.result()
+            if owner:
+                cache.put(key, value)
+            return value
+        finally:
+            if owner:
+                with self._lock:
+                    del self._in_flight[key]
+
+    def unit_names(self):
+        return sorted(name for name in os.listdir(self.data_path)
+                      if os.path.isfile(os.path.join(self.data_path, name, f'{name}.ssbp')))
+
+    def _stamps(self, unit):
+        unit_path = os.path.join(self.data_path, unit)
+        if '/' in unit or unit.startswith('.') or not os.path.isfile(os.path.join(unit_path, f'{unit}.ssbp')):
+            raise FileNotFoundError(f"Unit {unit} wasn't found")
+        stamps = []
+        for name in sorted(os.listdir(unit_path)):
+            stat = os.stat(os.path.join(unit_path, name))
+            stamps.append((name, stat.st_mtime, stat.st_size))
+        return tuple(stamps)
+
+    def decoder(self, unit):
+        # Decoders crop the cells straight out of the atlases, nothing has to be split beforehand.
+        # Units split into a sprite store load their cells from the store instead, sharing the decoded
+        # and transformed sprites with every other unit in the store
+        def build():
+            with open(os.path.join(self.data_path, unit, f'{unit}.ssbp'), 'rb') as file:
+                ssbp = SSBP(file)
+            export_path = os.path.join(self.output_path, unit)
+            stored = os.path.exists(os.path.join(export_path, 'tex', MAPPING_NAME))
+            return SSFrameDecoder(ssbp, export_path=export_path, texture_cache=self.texture_cache,
+                                  cell_index=None if stored else cell_index(unit, ssbp, self.data_path))
+        return self._coalesced(self.units, ('unit', unit, self._stamps(unit)), build)
+
+    @staticmethod
+    def _animation(decoder, package_name, animation_name):
+        package = decoder.animation_packages.get(package_name)
+        if package is None or animation_name not in package['animations']:
+            raise KeyError(f"{package_name}/{animation_name} wasn't found")
+        return package['animations'][animation_name]
+
+    def unit_info(self, unit):
+        decoder = self.decoder(unit)
+        return {
+            'unit': unit,
+            'cells': len(decoder.cells),
+            'packages': {
+                package_name: {animation_name: {'frame count': animation['frame count'], 'fps': animation['fps']}
+                               for animation_name, animation in package['animations'].items()}
+                for package_name, package in decoder.animation_packages.items()
+            }
+        }
+
+    @staticmethod
+    def sheet_layout(frame_count):
+        # Frames are laid out row by row in a grid that's as square as possible
+        columns = max(math.ceil(math.sqrt(frame_count)), 1)
+        return columns, max(math.ceil(frame_count / columns), 1)
+
+    def animation_info(self, unit, package_name, animation_name, quality='full', canvas=None):
+        decoder = self.decoder(unit)
+        animation = self._animation(decoder, package_name, animation_name)
+        frame_size, origin = decoder.canvas_layout(package_name, animation_name, canvas,
+                                                   RENDER_QUALITIES[quality]['scale'])
+        columns, rows = self.sheet_layout(animation['frame count'])
+        return {
+            'unit': unit,
+            'package': package_name,
+            'animation': animation_name,
+            'frame count': animation['frame count'],
+            'fps': animation['fps'],
+            'canvas size': list(animation['canvas size']),
+            'labels': animation['label data']['data'],
+            'user data': animation['user data']['data'],
+            'bounds': decoder.animation_bounds(package_name, animation_name),
+            'sheet': {'frame size': list(frame_size), 'origin': list(origin), 'columns': columns, 'rows': rows}
+        }
+
+    def frame(self, unit, package_name, animation_name, time, quality='full', canvas=None):
+        # Encoded frame, time is a frame or a label name
+        decoder = self.decoder(unit)
+        animation = self._animation(decoder, package_name, animation_name)
+        if not isinstance(time, int):
+            time = decoder.label_time(package_name, animation_name, time)
+        if not 0 <= time < animation['frame count']:
+            raise IndexError(f"Frame {time} is out of range, {animation_name} has {animation['frame count']} frames")
+        key = ('frame', unit, self._stamps(unit), package_name, animation_name, time, quality, canvas)
+        return self._coalesced(self.responses, key, lambda: encode_image(decoder.render_frame(
+            package_name, animation_name, time, debug=False, canvas=canvas, quality=quality), self.profile),
+            pooled=True)
+
+    def sheet(self, unit, package_name, animation_name, quality='full', canvas=None):
+        decoder = self.decoder(unit)
+        animation = self._animation(decoder, package_name, animation_name)
+
+        def build():
+            columns, rows = self.sheet_layout(animation['frame count'])
+            sheet = None
+            for time in range(animation['frame count']):
+                image = decoder.render_frame(package_name, animation_name, time, debug=False, canvas=canvas,
+                                             quality=quality)
+                if sheet is None:
+                    sheet = Image.new('RGBA', (image.size[0] * columns, image.size[1] * rows), (0, 0, 0, 0))
+                sheet.paste(image, ((time % columns) * image.size[0], (time // columns) * image.size[1]))
+            return encode_image(sheet or Image.new('RGBA', (1, 1)), self.profile)
+
+        key = ('sheet', unit, self._stamps(unit), package_name, animation_name, quality, canvas)
+        return self._coalesced(self.responses, key, build, pooled=True)
+
+
+def make_handler(render_server):
+    extension = '.' + ENCODE_PROFILES[render_server.profile]['extension']
+    content_type = CONTENT_TYPES[ENCODE_PROFILES[render_server.profile]['format']]
+
+    class RenderRequestHandler(BaseHTTPRequestHandler):
+        def send_body(self, status, body, body_type):
+            self.send_response(status)
+            self.send_header('Content-Type', body_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, status, value):
+            self.send_body(status, json.dumps(value).encode(), 'application/json')
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            path = [unquote(segment) for segment in url.path.split('/') if segment]
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            quality = query.get('quality', 'full')
+            canvas = query.get('canvas')
+            try:
+                if quality not in RENDER_QUALITIES:
+                    raise ValueError(f'Unknown quality {quality}, use one of {", ".join(RENDER_QUALITIES)}')
+                if canvas not in (None, 'auto'):
+                    raise ValueError('canvas can only be auto')
+
+                if path in ([], ['units']):
+                    self.send_json(200, render_server.unit_names())
+                elif len(path) == 2 and path[0] == 'units':
+                    self.send_json(200, render_server.unit_info(path[1]))
+                elif len(path) == 4 and path[0] == 'units':
+                    self.send_json(200, render_server.animation_info(*path[1:], quality=quality, canvas=canvas))
+                elif len(path) == 5 and path[0] == 'units' and path[4].endswith(extension):
+                    name = path[4][:-len(extension)]
+                    if name == 'sheet':
+                        body = render_server.sheet(*path[1:4], quality=quality, canvas=canvas)
+                    else:
+                        body = render_server.frame(*path[1:4], int(name) if name.isdigit() else name,
+                                                   quality=quality, canvas=canvas)
+                    self.send_body(200, body, content_type)
+                else:
+                    self.send_json(404, {'error': f'Unknown path {url.path}'})
+            except (FileNotFoundError, KeyError, IndexError) as error:
+                self.send_json(404, {'error': str(error).strip("'\"")})
+            except ValueError as error:
+                self.send_json(400, {'error': str(error)})
+            except Exception as error:
+                self.send_json(500, {'error': f'{type(error).__name__}: {error}'})
+
+    return RenderRequestHandler
+
+
+def serve(data_path='data/Unit', host='127.0.0.1', port=8000, **kwargs):
+    # Serve until interrupted
+    render_server = RenderServer(data_path, **kwargs)
+    http_server = ThreadingHTTPServer((host, port), make_handler(render_server))
+    http_server.daemon_threads = True
+    print(f'Serving {data_path} on http://{host}:{http_server.server_address[1]}/units', file=sys.stderr)
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        render_server.close()
+
+
+if __name__ == "__main__":
+    serve()
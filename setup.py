@@ -0,0 +1,33 @@
+from setuptools import setup
+
+setup(
+    name='feh-ssbp',
+    version='0.1.0',
+    description='SSBP decompiler intended for use with Fire Emblem Heroes files',
+    url='https://github.com/awaken1ng/feh-ssbp',
+    python_requires='>=3.7',
+    install_requires=['Pillow'],
+    py_modules=[
+        'catalog',
+        'cli',
+        'dump_frames',
+        'export_frames',
+        'export_layers',
+        'frame_decoder',
+        'manifest',
+        'output',
+        'pipeline',
+        'server',
+        'split_cell',
+        'sprite_store',
+        'ssbp',
+        'sstypes',
+        'stream_frames',
+        'texture_cache',
+        'utility',
+        'watch',
+    ],
+    entry_points={
+        'console_scripts': ['feh-ssbp=cli:main'],
+    },
+)
@@ -1,28 +1,210 @@
+import json
 import os
+import shutil
 from ssbp import SSBP
 from PIL import Image
+from output import ENCODE_PROFILES, ImageWriter, output_path as encoded_path
+from manifest import Manifest
+from sprite_store import MAPPING_NAME, write_mapping
 
+# Written instead of the crops when splitting with index=True
+INDEX_NAME = 'index.json'
 
-def split_cellmap(unit, ssbp):
-    for cell_map_name in ssbp.cell_maps:
-        cell_map = ssbp.cell_maps[cell_map_name]
-        # Check if texture exists
-        if os.path.exists(os.path.join(f'data/Unit/{unit}', cell_map['image path'])):
-            # Create the output folders if it doesn't exist
-            for path in ['output', f'output/{unit}', f'output/{unit}/tex']:
-                if not os.path.exists(path):
-                    os.mkdir(path)
-            # Open the texture
-            tex_im = Image.open(f"data/Unit/{unit}/{cell_map['image path']}")
+
+def _link(source, destination):
+    # Hardlink the duplicate cell to the already written crop, copy if the filesystem can't link
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def cell_index(unit, ssbp, data_path='data/Unit'):
+    # Texture path and rectangle of every cell, the frame decoder crops the cells out of the atlases
+    # directly instead of reading thousands of small files
+    cells = {}
+    for cell_map in ssbp.cell_maps.values():
+        texture_path = os.path.join(data_path, unit, cell_map['image path'])
+        if not os.path.exists(texture_path):
+            continue
+        for cell in cell_map['cells']:
+            cells[cell['name']] = {'texture': texture_path, 'rect': cell['pos'] + cell['size']}
+    return cells
+
+
+def write_cell_index(unit, ssbp, data_path='data/Unit', output_path='output'):
+    tex_path = os.path.join(output_path, unit, 'tex')
+    os.makedirs(tex_path, exist_ok=True)
+    with open(os.path.join(tex_path, INDEX_NAME), 'w') as file:
+        json.dump({'cells': cell_index(unit, ssbp, data_path)}, file, indent=1, sort_keys=True)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _remove_crops(tex_path, manifest=None):
+    # Remove the crops of a previous split into files, and their manifest entries
+    extensions = {'.' + settings['extension'] for settings in ENCODE_PROFILES.values()}
+    for name in os.listdir(tex_path):
+        if os.path.splitext(name)[1] in extensions:
+            path = os.path.join(tex_path, name)
+            os.remove(path)
+            if manifest:
+                manifest.forget(os.path.relpath(path, manifest.root))
+
+
+def store_cellmap(unit, ssbp, store, data_path='data/Unit', output_path='output', writer=None, texture_cache=None,
+                  workers=4, manifest=None):
+    # Crop the cells into the sprite store, identical pixels are stored once for every unit,
+    # the unit only gets the mapping of its cell names to the hashes of their pixels
+    tex_path = os.path.join(output_path, unit, 'tex')
+    os.makedirs(tex_path, exist_ok=True)
+    _remove(os.path.join(tex_path, INDEX_NAME))
+
+    own_writer = writer is None
+    if own_writer:
+        writer = ImageWriter(profile=store.profile, workers=workers)
+    cell_hashes, renames = {}, {}
+    try:
+        for cell_map in ssbp.cell_maps.values():
+            texture_path = os.path.join(data_path, unit, cell_map['image path'])
+            if not os.path.exists(texture_path):
+                continue
+            if texture_cache:
+                tex_im = texture_cache.get(texture_path)
+            else:
+                tex_im = Image.open(texture_path)
+                tex_im.load()
+            hashes = {}  # rectangle: hash
             for cell in cell_map['cells']:
-                # Cut out the part
-                part = tex_im.crop(
-                    cell['pos'] + (cell['size'][0] + cell['pos'][0],
-                                   cell['size'][1] + cell['pos'][1])
-                )
-                # Save it
-                part.save(f"output/{unit}/tex/{cell['name']}.png")
+                rect = cell['pos'] + (cell['size'][0] + cell['pos'][0],
+                                      cell['size'][1] + cell['pos'][1])
+                if rect not in hashes:
+                    hashes[rect] = store.add(tex_im.crop(rect), writer, renames)
+                cell_hashes[cell['name']] = hashes[rect]
+    finally:
+        if own_writer:
+            writer.close()
+        else:
+            writer.flush()
+
+    if writer.errors:
+        raise writer.errors[0][1]
+    for path, temporary_path in renames.items():
+        if os.path.exists(temporary_path):
+            os.replace(temporary_path, path)
+    write_mapping(tex_path, store, cell_hashes)
+    _remove_crops(tex_path, manifest)
+
+
+def split_cellmap(unit, ssbp, data_path='data/Unit', output_path='output', profile='fast', writer=None,
+                  texture_cache=None, manifest=None, index=False, workers=4, store=None):
+    # Crops are intermediate artifacts, so the fast encode profile is used by default.
+    # Each atlas is decoded once, cells sharing a rectangle are encoded once and hardlinked,
+    # crops are encoded on the writer's threads, and with a manifest the crops that are
+    # already up to date are skipped. With index=True only an index of the cells in the atlases is written,
+    # with a SpriteStore the crops go to the store shared by every unit
+    if index:
+        _remove(os.path.join(output_path, unit, 'tex', MAPPING_NAME))
+        write_cell_index(unit, ssbp, data_path, output_path)
+        _remove_crops(os.path.join(output_path, unit, 'tex'), manifest)
+        return
+    if store:
+        store_cellmap(unit, ssbp, store, data_path=data_path, output_path=output_path, writer=writer,
+                      texture_cache=texture_cache, workers=workers, manifest=manifest)
+        return
+
+    tex_path = os.path.join(output_path, unit, 'tex')
+    # Create the output folders if it doesn't exist
+    os.makedirs(tex_path, exist_ok=True)
+    _remove(os.path.join(tex_path, INDEX_NAME))
+    _remove(os.path.join(tex_path, MAPPING_NAME))
+
+    own_writer = writer is None
+    if own_writer:
+        writer = ImageWriter(profile=profile, workers=workers)
+    duplicates = []
+    try:
+        for cell_map_name in ssbp.cell_maps:
+            cell_map = ssbp.cell_maps[cell_map_name]
+            texture_path = os.path.join(data_path, unit, cell_map['image path'])
+            # Check if texture exists
+            if not os.path.exists(texture_path):
+                continue
+            texture_hash = manifest.file_hash(texture_path) if manifest else None
+
+            tex_im = None
+            written = {}  # rectangle: path of the crop
+            for cell in cell_map['cells']:
+                rect = cell['pos'] + (cell['size'][0] + cell['pos'][0],
+                                      cell['size'][1] + cell['pos'][1])
+                path = encoded_path(os.path.join(tex_path, f"{cell['name']}.png"), profile)
+                duplicate = rect in written
+                if not duplicate:
+                    written[rect] = path
+
+                if manifest:
+                    artifact = os.path.relpath(path, manifest.root)
+                    inputs = {'texture': texture_hash, 'rect': rect, 'profile': profile}
+                    if manifest.is_up_to_date(artifact, inputs):
+                        continue
+                    manifest.record(artifact, inputs)
+                if duplicate:
+                    duplicates.append((written[rect], path))
+                    continue
+
+                # Open the texture only once something has to be cut out of it
+                if tex_im is None:
+                    if texture_cache:
+                        tex_im = texture_cache.get(texture_path)
+                    else:
+                        tex_im = Image.open(texture_path)
+                        tex_im.load()
+                # Cut out the part and queue it for saving
+                writer.save(tex_im.crop(rect), path, profile)
+    finally:
+        if own_writer:
+            writer.close()
+        else:
+            writer.flush()
+
+    if writer.errors:
+        path, error = writer.errors[0]
+        if manifest:
+            failed = {path for path, _ in writer.errors}
+            failed.update(destination for source, destination in duplicates if source in failed)
+            for path in failed:
+                manifest.forget(os.path.relpath(path, manifest.root))
+        raise error
+
+    for source, destination in duplicates:
+        _link(source, destination)
+
+
+def update_cellmap(unit, ssbp, manifest, data_path='data/Unit', output_path='output', profile='fast', **kwargs):
+    # Split the cell maps unless they were already split from the same unit files and profile,
+    # returns whether the cell maps were split
+    store = kwargs.get('store')
+    inputs = {'unit files': manifest.folder_hashes(os.path.join(data_path, unit)), 'profile': profile,
+              'index': kwargs.get('index', False),
+              'store': [os.path.abspath(store.path), store.profile] if store else None}
+    if manifest.is_up_to_date('tex', inputs):
+        return False
+    split_cellmap(unit, ssbp, data_path=data_path, output_path=output_path, profile=profile,
+                  manifest=manifest, **kwargs)
+    manifest.record('tex', inputs)
+    return True
+
 
 if __name__ == "__main__":
     unit = 'ch04_12_Tiki_F_Normal'
-    split_cellmap(unit)
+
+    with open(f'data/Unit/{unit}/{unit}.ssbp', 'rb') as file:
+        ssbp = SSBP(file)
+        manifest = Manifest(f'output/{unit}/manifest.json')
+        update_cellmap(unit, ssbp, manifest)
+        manifest.save()
@@ -0,0 +1,102 @@
+import hashlib
+import itertools
+import json
+import os
+import threading
+from output import ENCODE_PROFILES, load_image, output_path, save_image
+from texture_cache import mip_level
+from utility import LRUCache
+
+# Written to output/<unit>/tex instead of the crops when splitting into a sprite store,
+# {"store": path of the store relative to the file, "profile": encode profile, "cells": {cell name: content hash}}
+MAPPING_NAME = 'cells.json'
+
+
+class SpriteStore:
+    # Cell crops stored once for every unit, keyed by the hash of their pixels, so cells shared between units
+    # (weapons, effects, palette variants) are written, decoded and transformed once.
+    # Sprites are stored as <store>/<first two characters of the hash>/<hash>.<extension>.
+    # Decoded sprites and the transformed sprites of the renderers are kept in LRU caches keyed by hash,
+    # use SpriteStore.open to share one store and its caches between every decoder of the process
+    # Usage example:
+    # store = SpriteStore.open('output/.sprites')
+    # sprite_hash = store.add(image)
+    # sprite = store.get(sprite_hash)
+    _stores = {}
+    _stores_lock = threading.Lock()
+    _temporary_names = itertools.count()
+
+    def __init__(self, path='output/.sprites', profile='fast', cache_size=4096, transformed_cache_size=4096):
+        self.path = path
+        self.profile = profile
+        self.sprites = LRUCache(cache_size)  # (hash, mip level): sprite
+        self.transformed = LRUCache(transformed_cache_size)  # (hash, mip level, transform): sprite
+
+    @classmethod
+    def open(cls, path='output/.sprites', profile='fast', **kwargs):
+        key = (os.path.abspath(path), profile)
+        with cls._stores_lock:
+            if key not in cls._stores:
+                cls._stores[key] = cls(path, profile, **kwargs)
+            return cls._stores[key]
+
+    @staticmethod
+    def content_hash(image):
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        content = hashlib.sha1(f'{image.size[0]}x{image.size[1]}'.encode())
+        content.update(image.tobytes())
+        return content.hexdigest()
+
+    def sprite_path(self, sprite_hash):
+        extension = ENCODE_PROFILES[self.profile]['extension']
+        return os.path.join(self.path, sprite_hash[:2], f'{sprite_hash}.{extension}')
+
+    def add(self, image, writer=None, renames=None):
+        # Store the image unless the same pixels are already stored, returns the hash.
+        # With a writer the image is encoded on the writer's threads to a temporary path, and renames
+        # ({path: temporary path}) gets the temporary path, to be renamed once the writer is flushed.
+        # Images already pending in renames aren't written again
+        sprite_hash = self.content_hash(image)
+        path = self.sprite_path(sprite_hash)
+        if os.path.exists(path) or (renames is not None and path in renames):
+            return sprite_hash
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Other processes and splits may be storing the same sprite, only complete files are renamed into place
+        temporary_path = output_path(f'{path}.{os.getpid()}.{next(self._temporary_names)}.tmp', self.profile)
+        if writer is not None:
+            writer.save(image, temporary_path, self.profile)
+            renames[path] = temporary_path
+        else:
+            save_image(image, temporary_path, self.profile)
+            os.replace(temporary_path, path)
+        return sprite_hash
+
+    def get(self, sprite_hash, level=0):
+        # Decoded sprite, shared, so it must not be modified
+        key = (sprite_hash, level)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            if level:
+                sprite = mip_level(self.get(sprite_hash), level)
+            else:
+                sprite = load_image(self.sprite_path(sprite_hash))
+            self.sprites.put(key, sprite)
+        return sprite
+
+
+def write_mapping(tex_path, store, cell_hashes):
+    with open(os.path.join(tex_path, MAPPING_NAME), 'w') as file:
+        json.dump({'store': os.path.relpath(store.path, tex_path), 'profile': store.profile, 'cells': cell_hashes},
+                  file, indent=1, sort_keys=True)
+
+
+def load_mapping(tex_path):
+    # Returns the store and the cell hashes of a unit split into a store, None if it wasn't
+    path = os.path.join(tex_path, MAPPING_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        mapping = json.load(file)
+    return SpriteStore.open(os.path.normpath(os.path.join(tex_path, mapping['store'])), mapping['profile']), \
+        mapping['cells']
@@ -1,5 +1,7 @@
 from sstypes import SSWrapMode, SSFilterMode, SSPartType, SSBoundsType, SSBlendType
-from utility import read_i16le, read_i32le, read_f32le, read_str_from_pointer, peek
+from utility import read_i16le, read_i32le, read_u32le, read_f32le, read_str_from_pointer, peek
+
+__version__ = '0.1.0'
 
 
 class SSBP:
@@ -115,7 +117,7 @@ class SSBP:
                         'name': read_str_from_pointer(animations_buffer, read_i32le(animations_buffer)),
                         'initial frame data': {'pointer': read_i32le(animations_buffer), 'data': {}},
                         'frame data': {'pointer': read_i32le(animations_buffer), 'data': {}},
-                        'user data': {'pointer': read_i32le(animations_buffer), 'data': None},
+                        'user data': {'pointer': read_i32le(animations_buffer), 'data': {}},
                         'label data': {'pointer': read_i32le(animations_buffer), 'data': {}, 'count': None},
                         'frame count': read_i16le(animations_buffer),
                         'fps': read_i16le(animations_buffer)
@@ -257,16 +259,31 @@ class SSBP:
                                                             flags[flag]['data'].append(
                                                                 (read_i16le(frame_data_buffer), read_i16le(frame_data_buffer)))
                                                 elif value_type == 'color blend':
-                                                    raise NotImplementedError
-                                                    # Not tested
-                                                    type_and_flags = read_i16le(input_buffer)
-                                                    if type_and_flags & 4096:
-                                                        flags[flag] = [{'rate': read_f32le(input_buffer), 'rgba': read_i32le(input_buffer)}]
+                                                    # Low byte is the blend type, high byte the vertex flags,
+                                                    # either a single color for the whole quad or one for each
+                                                    # of the top left, top right, bottom left and bottom right vertices
+                                                    type_and_flags = read_i16le(input_buffer) & 0xFFFF
+                                                    vertex_flags = type_and_flags >> 8
+                                                    flags[flag] = {
+                                                        'type': SSBlendType.get(type_and_flags & 0xFF),
+                                                        'single': bool(vertex_flags & 0x10),
+                                                        'colors': []
+                                                    }
+                                                    if vertex_flags & 0x10:
+                                                        colors_count, vertex_flags = 1, 1
                                                     else:
-                                                        flags[flag] = []
-                                                        for vertex_index in range(4):
-                                                            if type_and_flags & (1 << vertex_index):
-                                                                flags[flag].append({'rate': read_f32le(input_buffer), 'rgba': read_i32le(input_buffer)})
+                                                        colors_count = 4
+                                                    for vertex_index in range(colors_count):
+                                                        if vertex_flags & (1 << vertex_index):
+                                                            rate = read_f32le(input_buffer)
+                                                            argb = read_u32le(input_buffer)
+                                                            flags[flag]['colors'].append({
+                                                                'rate': rate,
+                                                                'rgba': ((argb >> 16) & 0xFF, (argb >> 8) & 0xFF,
+                                                                         argb & 0xFF, (argb >> 24) & 0xFF)
+                                                            })
+                                                        else:
+                                                            flags[flag]['colors'].append(None)
                                         frame.update(flags)
 
                                     part_index = frame['part index']
@@ -278,18 +295,31 @@ class SSBP:
                                         animation['frame data']['data'][part_index] = []
                                     animation['frame data']['data'][part_index].append(frame)
 
-                    # TODO Read the user data if it's present
+                    # Read the user data if it's present, keyed by the frame, frames without user data are skipped
                     if animation['user data']['pointer']:
-                        raise NotImplementedError
                         with peek(input_buffer, animation['user data']['pointer']) as user_data_array_buffer:
-                            for _ in range(animation['frame count']):
-                                with peek(user_data_array_buffer, read_i32le(user_data_array_buffer)) as user_data_buffer:
-                                    for _ in range(package['animation parts']['count']):
-                                        pass
-                                        # for each attribute
-                                            # flags_value = read_i16
-                                            # part_index= read_i16
-                                            # if data_type
+                            for frame_index in range(animation['frame count']):
+                                user_data_pointer = read_i32le(user_data_array_buffer)
+                                if not user_data_pointer:
+                                    continue
+                                with peek(user_data_array_buffer, user_data_pointer) as user_data_buffer:
+                                    events = []
+                                    for _ in range(read_i16le(user_data_buffer) & 0xFFFF):
+                                        flags_value = read_i16le(user_data_buffer) & 0xFFFF
+                                        event = {'part index': read_i16le(user_data_buffer)}
+                                        if flags_value & (1 << 0):
+                                            event['integer'] = read_i32le(user_data_buffer)
+                                        if flags_value & (1 << 1):
+                                            event['rect'] = tuple(read_i32le(user_data_buffer) for _ in range(4))
+                                        if flags_value & (1 << 2):
+                                            event['point'] = tuple(read_i32le(user_data_buffer) for _ in range(2))
+                                        if flags_value & (1 << 3):
+                                            user_data_buffer.seek(2, 1)  # string length
+                                            event['string'] = read_str_from_pointer(user_data_buffer, read_i32le(user_data_buffer))
+                                        events.append(event)
+                                    animation['user data']['data'][frame_index] = events
+                                    if debug:
+                                        print(f"|- User data of frame {frame_index + 1} {events}")
 
                     # Read the label data if it's present
                     if animation['label data']['pointer']:
@@ -1,3 +1,5 @@
+from bisect import bisect_left
+from collections import namedtuple
 from enum import Enum
 
 
@@ -48,19 +50,55 @@ class SSBlendType(Enum):
 
 
 class AnimationInstance:
-    def __init__(self, keyframe, start, end, speed, loop, infinity, reverse, pingpong, independent):
+    __slots__ = ('keyframe', 'start', 'end', 'speed', 'loop', 'infinity', 'reverse', 'pingpong', 'independent')
+
+    def __init__(self, keyframe=0, start=0, end=None, speed=1.0, loop=1,
+                 infinity=False, reverse=False, pingpong=False, independent=False):
         self.keyframe = keyframe
         self.start = start
-        self.end = end
+        self.end = end  # None plays up to the last frame of the referenced animation
         self.speed = speed
-        self.loop = bool(loop)
+        self.loop = loop
         self.infinity = infinity
         self.reverse = reverse
         self.pingpong = pingpong
         self.independent = independent
 
+    def local_time(self, time, frame_count):
+        # Map the time of the parent animation to the frame of the referenced animation,
+        # returns None if the instance hasn't started yet
+        start = self.start
+        end = self.end if self.end is not None else frame_count - 1
+        end = min(end, frame_count - 1)
+
+        elapsed = int((time - self.keyframe) * self.speed)
+        if elapsed < 0:
+            return None
+        length = end - start + 1
+        if length <= 0:
+            return None
+
+        loop = elapsed // length
+        loop_count = self.loop * 2 if self.pingpong else self.loop
+        if not self.infinity and loop >= loop_count:
+            # Hold the last frame once all the loops are played out
+            elapsed = length - 1
+            loop = max(loop_count - 1, 0)
+
+        local_time = elapsed % length
+        reverse = self.reverse
+        if self.pingpong and loop % 2 == 1:
+            reverse = not reverse
+        if reverse:
+            local_time = length - 1 - local_time
+        return start + local_time
+
 
 class SSPartState:
+    __slots__ = ('part', 'hide', 'flph', 'flpv', 'cell', 'posx', 'posy', 'posz', 'alph', 'pvtx', 'pvty',
+                 'rotx', 'roty', 'rotz', 'sclx', 'scly', 'sizx', 'sizy', 'uvtx', 'uvty', 'uvrz', 'uvsx', 'uvsy',
+                 'bndr', 'parent', 'vertex', 'colb', 'instance', 'vertices', 'matrix', '_posx', '_posy', '_rotz')
+
     def __init__(self,
                  part_index,
                  hide=False,
@@ -112,8 +150,13 @@ class SSPartState:
         self.bndr = bounding_radius
         self.parent = None
         self.vertex = None
+        self.colb = None
         self.instance = None
         self.vertices = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+        self.matrix = None
+        self._posx = 0
+        self._posy = 0
+        self._rotz = 0
 
     def __iter__(self):
         parent = self.parent
@@ -147,20 +190,25 @@ class SSPartState:
         self.uvsy = frame['v scale']
         self.bndr = frame['bounding radius']
         self.vertex = None
+        self.colb = None
         self.instance = None
         if 'vertex transform' in frame.keys():
             self.vertex = frame['vertex transform']
-        if 'instance keyframe' in frame.keys():
+        if 'color blend' in frame.keys():
+            self.colb = frame['color blend']
+        if any(key.startswith('instance') for key in frame.keys()):
+            # Only the values that differ from the defaults are stored in the frame
+            loop_flags = frame.get('instance loop flags', {})
             self.instance = AnimationInstance(
-                frame['instance keyframe'],
-                frame['instance start'],
-                frame['instance end'],
-                frame['instance speed'],
-                frame['instance loop'],
-                frame['instance loop flags']['infinity'],
-                frame['instance loop flags']['reverse'],
-                frame['instance loop flags']['pingpong'],
-                frame['instance loop flags']['independent']
+                frame.get('instance keyframe', 0),
+                frame.get('instance start', 0),
+                frame.get('instance end'),
+                frame.get('instance speed', 1.0),
+                frame.get('instance loop', 1),
+                loop_flags.get('infinity', False),
+                loop_flags.get('reverse', False),
+                loop_flags.get('pingpong', False),
+                loop_flags.get('independent', False)
             )
         return self
 
@@ -190,7 +238,8 @@ class SSPartState:
             'u scale':         self.uvsx,
             'v scale':         self.uvsy,
             'bounding radius': self.bndr,
-            'vertex transform': self.vertex
+            'vertex transform': self.vertex,
+            'color blend':     self.colb
         }
 
     def __repr__(self):
@@ -227,10 +276,15 @@ class SSPartState:
 
 
 class SSAnimationPart:
+    # Parts don't change between frames, so a single instance is shared by every frame
+    __slots__ = ('name', 'index', 'parent_index', 'parent', 'type', 'bounds_type', 'alpha_blend_type',
+                 'animation_instance_name', 'effect_name', 'color')
+
     def __init__(self,
                  name=None,
                  index=None,
                  parent_index=None,
+                 type=None,
                  bounds_type=None,
                  alpha_blend_type=None,
                  animation_instance_name=None,
@@ -239,6 +293,7 @@ class SSAnimationPart:
         self.index = index
         self.parent_index = parent_index
         self.parent = None
+        self.type = type
         self.bounds_type = bounds_type
         self.alpha_blend_type = alpha_blend_type
         self.animation_instance_name = animation_instance_name if animation_instance_name else None
@@ -270,39 +325,19 @@ class SSAnimationPart:
                f"color='{self.color}'>"
 
 
-class SSVector2:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
+class SSVector2(namedtuple('SSVector2', ['x', 'y'])):
+    # Immutable, arithmetic returns a new vector
+    __slots__ = ()
 
     def __add__(self, other):
-        self.x = other + self.x
-        self.y = other + self.y
-        return self
+        if isinstance(other, tuple):
+            return SSVector2(self.x + other[0], self.y + other[1])
+        return SSVector2(self.x + other, self.y + other)
 
     def __sub__(self, other):
-        self.x = other - self.x
-        self.y = other - self.y
-        return self
-
-    def __getitem__(self, item):
-        if item == 0:
-            return self.x
-        elif item == 1:
-            return self.y
-        else:
-            raise IndexError
-
-    def __setitem__(self, key, value):
-        if isinstance(value, int) or isinstance(value, float):
-            if key == 0:
-                self.x = value
-            elif key == 1:
-                self.y = value
-            else:
-                raise IndexError
-        else:
-            raise TypeError('Value has to be integer or float')
+        if isinstance(other, tuple):
+            return SSVector2(self.x - other[0], self.y - other[1])
+        return SSVector2(self.x - other, self.y - other)
 
     def __str__(self):
         return f"({self.x}, {self.y})"
@@ -312,6 +347,9 @@ class SSVector2:
 
 
 class SSCell:
+    # Cells don't change between frames, so a single instance is shared by every frame
+    __slots__ = ('name', 'index', 'position', 'size', 'pivot')
+
     def __init__(self, name=None, index=None, position=None, size=None, pivot=None):
         self.name = name
         self.index = index
@@ -332,4 +370,35 @@ class SSCell:
                        f"index={self.index}, " \
                        f"position=({self.position.x}, {self.position.y}), " \
                        f"size=({self.size.x}, {self.size.y}), " \
-                       f"pivot=({self.pivot.x}, {self.pivot.y})>"
\ No newline at end of file
+                       f"pivot=({self.pivot.x}, {self.pivot.y})>"
+
+class SSUserDataIndex:
+    # Sorted index of an animation's user data events for range lookups by frame
+    # Usage example:
+    # index = SSUserDataIndex(animation['user data']['data'])
+    # index.events(0, 10)  # [(frame, event), ...] of the frames 0 to 9
+    __slots__ = ('frames', 'frame_events')
+
+    def __init__(self, user_data):
+        self.frames = sorted(user_data)
+        self.frame_events = [user_data[frame] for frame in self.frames]
+
+    def __len__(self):
+        return sum(len(events) for events in self.frame_events)
+
+    def events(self, start, end, part_index=None):
+        # Events in frames [start, end), optionally only those of a part
+        result = []
+        for position in range(bisect_left(self.frames, start), bisect_left(self.frames, end)):
+            frame = self.frames[position]
+            for event in self.frame_events[position]:
+                if part_index is None or event['part index'] == part_index:
+                    result.append((frame, event))
+        return result
+
+    def next_event(self, time):
+        # First frame with events at or after the time and its events, None if there are none left
+        position = bisect_left(self.frames, time)
+        if position == len(self.frames):
+            return None
+        return self.frames[position], self.frame_events[position]
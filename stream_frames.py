@@ -0,0 +1,109 @@
+import os
+import socket
+import struct
+import sys
+from ssbp import SSBP
+from frame_decoder import SSFrameDecoder, render_quality
+
+# Raw RGBA frame stream, frames are written back to back as width * height * 4 bytes of RGBA pixels,
+# rows top to bottom. Without headers every frame of an animation has the canvas size, so the stream can be
+# read as raw video, e.g. ffmpeg -f rawvideo -pix_fmt rgba -s <width>x<height> -r <fps> -i -
+#
+# With headers every frame is preceded by FRAME_HEADER (little endian):
+#   magic     4 bytes  b'SSFR'
+#   width     uint32
+#   height    uint32
+#   offset x  int32    canvas position of the animation origin
+#   offset y  int32
+#   duration  uint32   display time of the frame in microseconds
+
+FRAME_MAGIC = b'SSFR'
+FRAME_HEADER = struct.Struct('<4sIIiiI')
+
+
+class FrameStream:
+    # Writes frames to stdout ('-'), a Unix socket ('unix:<path>') or a file or named pipe path.
+    # Pixels are written from the rendered image's bytes with no encoding, and the header is
+    # written separately instead of being joined to the pixels
+    # Usage example:
+    # with FrameStream('unix:/tmp/encoder.sock', header=True) as stream:
+    #     stream.write(image, origin=(100, 245), duration=33333)
+    def __init__(self, target='-', header=False):
+        self.target = target
+        self.header = header
+        self._socket = None
+        self._file = None
+        if target == '-':
+            self._file = os.fdopen(sys.stdout.fileno(), 'wb', buffering=0, closefd=False)
+        elif target.startswith('unix:'):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(target[len('unix:'):])
+        else:
+            self._file = open(target, 'wb', buffering=0)
+
+    def _write(self, data):
+        # Unbuffered writes can be partial, keep writing the rest of the same buffer
+        view = memoryview(data)
+        write = self._socket.send if self._socket else self._file.write
+        while view:
+            view = view[write(view):]
+
+    def write(self, image, origin=(0, 0), duration=0):
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        if self.header:
+            self._write(FRAME_HEADER.pack(FRAME_MAGIC, image.size[0], image.size[1],
+                                          round(origin[0]), round(origin[1]), round(duration)))
+        self._write(image.tobytes())
+
+    def close(self):
+        if self._socket:
+            self._socket.close()
+        elif self._file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_frames(file):
+    # Read a stream written with headers, yields (width, height, origin, duration, pixels)
+    while True:
+        header = file.read(FRAME_HEADER.size)
+        if not header:
+            return
+        magic, width, height, origin_x, origin_y, duration = FRAME_HEADER.unpack(header)
+        if magic != FRAME_MAGIC:
+            raise ValueError('Stream is out of sync, frame header expected')
+        yield width, height, (origin_x, origin_y), duration, file.read(width * height * 4)
+
+
+def stream_animation(decoder, stream, package_name, animation_name, frames=None, loops=1, canvas=None,
+                     quality='full'):
+    # Render the frames of the animation straight into the stream, returns the amount of frames written
+    animation = decoder.animation_packages[package_name]['animations'][animation_name]
+    _, origin = decoder.canvas_layout(package_name, animation_name, canvas, render_quality(quality)[0])
+    duration = 1000000 / animation['fps'] if animation['fps'] else 0
+    written = 0
+    for _ in range(loops):
+        for time in range(animation['frame count']):
+            if frames is not None and time not in frames:
+                continue
+            image = decoder.render_frame(package_name, animation_name, time, debug=False, canvas=canvas,
+                                         quality=quality)
+            stream.write(image, origin, duration)
+            written += 1
+    return written
+
+
+if __name__ == "__main__":
+    unit = 'ch04_12_Tiki_F_Normal'
+
+    with open(f'data/Unit/{unit}/{unit}.ssbp', 'rb') as file:
+        ssbp = SSBP(file)
+        decoder = SSFrameDecoder(ssbp, export_path=f'output/{unit}')
+        with FrameStream('-') as stream:
+            stream_animation(decoder, stream, 'body_anim', 'Idle')
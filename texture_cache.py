@@ -0,0 +1,114 @@
+import hashlib
+import mmap
+import os
+import threading
+from PIL import Image
+from output import RAW_HEADER, RAW_MAGIC, save_raw
+
+
+def mip_level(image, level):
+    # Box filtered image at 1/2**level of the size, averaged with premultiplied alpha
+    # so transparent pixels don't bleed their color into the edges
+    if not level:
+        return image
+    factor = 2 ** level
+    reduced = image.convert('RGBa').reduce((min(factor, image.size[0]), min(factor, image.size[1])))
+    return reduced.convert('RGBA')
+
+
+class TextureCache:
+    # Decoded atlases stored once as raw RGBA files keyed by the hash of the source image.
+    # Cached files are memory-mapped, so every process using the cache shares the same pages
+    # and opening a texture is a page-in instead of a PNG inflate
+    # Usage example:
+    # cache = TextureCache('output/.texture_cache')
+    # atlas = cache.get('data/Unit/ch04_12_Tiki_F_Normal/ch04_12_Tiki_F_Normal.png')
+    # half = cache.get('data/Unit/ch04_12_Tiki_F_Normal/ch04_12_Tiki_F_Normal.png', level=1)
+    _caches = {}
+    _caches_lock = threading.Lock()
+
+    def __init__(self, cache_path='output/.texture_cache'):
+        self.cache_path = cache_path
+        os.makedirs(cache_path, exist_ok=True)
+        self._lock = threading.RLock()  # Reentrant, mip levels map the previous level while holding it
+        self._hashes = {}  # (path, mtime, size): hash, to avoid hashing unchanged sources again
+        self._maps = {}  # hash: (mmap, size)
+
+    @classmethod
+    def open(cls, cache_path='output/.texture_cache'):
+        # One cache per folder and process, so every unit rendered by the process shares the mapped textures
+        key = os.path.abspath(cache_path)
+        with cls._caches_lock:
+            if key not in cls._caches:
+                cls._caches[key] = cls(cache_path)
+            return cls._caches[key]
+
+    def source_hash(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+        if key not in self._hashes:
+            with open(path, 'rb') as file:
+                self._hashes[key] = hashlib.sha1(file.read()).hexdigest()
+        return self._hashes[key]
+
+    def cached_path(self, path, level=0):
+        if level:
+            return os.path.join(self.cache_path, f'{self.source_hash(path)}.mip{level}.rgba')
+        return os.path.join(self.cache_path, f'{self.source_hash(path)}.rgba')
+
+    def _decode(self, path, cached_path):
+        # Write to a temporary file first, so other processes never map a partial texture
+        temporary_path = f'{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with Image.open(path) as image:
+            save_raw(image, temporary_path)
+        os.replace(temporary_path, cached_path)
+
+    def _map(self, path, level=0):
+        texture_hash = self.source_hash(path)
+        key = (texture_hash, level)
+        with self._lock:
+            if key not in self._maps:
+                cached_path = self.cached_path(path, level)
+                if not os.path.exists(cached_path):
+                    if level:
+                        self._reduce(path, level, cached_path)
+                    else:
+                        self._decode(path, cached_path)
+                with open(cached_path, 'rb') as file:
+                    texture_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, width, height = RAW_HEADER.unpack_from(texture_map)
+                if magic != RAW_MAGIC:
+                    raise ValueError(f'{cached_path} is not a raw RGBA file')
+                self._maps[key] = (texture_map, (width, height))
+            return self._maps[key]
+
+    def _reduce(self, path, level, cached_path):
+        # Mip levels are built from the previous level, each one half the size of the previous one
+        texture_map, size = self._map(path, level - 1)
+        previous = Image.frombuffer('RGBA', size, memoryview(texture_map)[RAW_HEADER.size:], 'raw', 'RGBA', 0, 1)
+        temporary_path = f'{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        save_raw(mip_level(previous, 1), temporary_path)
+        os.replace(temporary_path, cached_path)
+
+    def get(self, path, level=0):
+        # Read-only Pillow image backed by the mapped file, crop or copy it before modifying,
+        # level > 0 returns the mip level of the texture, 1/2**level of the size
+        texture_map, size = self._map(path, level)
+        buffer = memoryview(texture_map)[RAW_HEADER.size:]
+        return Image.frombuffer('RGBA', size, buffer, 'raw', 'RGBA', 0, 1)
+
+    def array(self, path):
+        # Read-only (height, width, 4) NumPy view of the mapped file
+        import numpy
+        texture_map, size = self._map(path)
+        return numpy.frombuffer(texture_map, dtype=numpy.uint8, count=size[0] * size[1] * 4,
+                                offset=RAW_HEADER.size).reshape(size[1], size[0], 4)
+
+    def close(self):
+        with self._lock:
+            for texture_map, _ in self._maps.values():
+                try:
+                    texture_map.close()
+                except BufferError:
+                    pass  # Still referenced by an image, released once the image is gone
+            self._maps.clear()
@@ -1,5 +1,7 @@
 import struct
 import math
+import threading
+from collections import OrderedDict
 
 
 # Utility functions for file reading
@@ -15,6 +17,10 @@ def read_i32le(input_buffer):
     return struct.unpack('<i', input_buffer.read(4))[0]
 
 
+def read_u32le(input_buffer):
+    return struct.unpack('<I', input_buffer.read(4))[0]
+
+
 def read_f32le(input_buffer):
     return struct.unpack('<f', input_buffer.read(4))[0]
 
@@ -187,4 +193,33 @@ def rotate_around(point, center, angle):
                 point[1] - center[1]) * math.sin(angle),
         center[1] + (point[0] - center[0]) * math.sin(angle) + (
                 point[1] - center[1]) * math.cos(angle)
-    )
\ No newline at end of file
+    )
+
+
+class LRUCache:
+    # Thread-safe cache of up to size values, the least recently used value is dropped first
+    def __init__(self, size):
+        self.size = size
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._values:
+                return default
+            self._values.move_to_end(key)
+            return self._values[key]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def put(self, key, value):
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
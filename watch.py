@@ -0,0 +1,174 @@
+import fnmatch
+import os
+import time as clock
+import traceback
+from ssbp import SSBP
+from split_cell import update_cellmap
+from manifest import Manifest, render_inputs, texture_inputs
+from frame_decoder import SSFrameDecoder
+from output import output_path, save_image
+
+
+class UnitWatcher:
+    # Keeps one unit parsed and its frames rendered. On every update only the changed .ssbp is parsed again,
+    # animations whose data didn't change are skipped without resolving their frames, and in the rest only
+    # the frames whose resolved part states or textures changed are rendered. The decoder and its sprite
+    # caches are kept between updates, so an update after a small edit only costs the changed frames
+    # Usage example:
+    # watcher = UnitWatcher('ch04_12_Tiki_F_Normal')
+    # while True:
+    #     if watcher.changed():
+    #         print(watcher.update())
+    #     time.sleep(0.5)
+    def __init__(self, unit, data_path='data/Unit', output_path='output', profile='compact', texture_profile='fast',
+                 canvas=None, quality='full', packages=None, animations=None, index=False, store=None,
+                 texture_cache=None):
+        self.unit = unit
+        self.data_path = data_path
+        self.unit_path = os.path.join(data_path, unit)
+        self.output_path = output_path
+        self.unit_output_path = os.path.join(output_path, unit)
+        self.profile = profile
+        self.texture_profile = texture_profile
+        self.canvas = canvas
+        self.quality = quality
+        self.packages = packages
+        self.animations = animations
+        # Split mode of the cell maps, as with split_cell.split_cellmap
+        self.index = index
+        self.store = store
+        self.texture_cache = texture_cache
+
+        self.manifest = Manifest(os.path.join(self.unit_output_path, 'manifest.json'))
+        self.ssbp = None
+        self.decoder = None
+        self.stamps = {}  # file name: (mtime, size) of the unit files at the last update
+        self.animation_keys = {}  # (package, animation): key of the data the animation was rendered from
+
+    def _stamps(self):
+        stamps = {}
+        for name in os.listdir(self.unit_path):
+            path = os.path.join(self.unit_path, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                stamps[name] = (stat.st_mtime, stat.st_size)
+        return stamps
+
+    def changed(self):
+        return self._stamps() != self.stamps
+
+    def _animation_key(self, package_name, animation_name, textures):
+        # The animation's own data, its parts, the cells and the data of the animations its parts instance
+        package = self.decoder.animation_packages[package_name]
+        animation = package['animations'][animation_name]
+        inputs = {
+            'animation': [animation['initial frame data']['data'], animation['frame data']['data'],
+                          animation['canvas size']],
+            'parts': package['animation parts']['data'],
+            'cells': self.decoder.cells,
+            'textures': textures
+        }
+        for part in package['animation parts']['data']:
+            instance_name = part['animation instance name']
+            instanced = instance_name and self.decoder.instanced_animation(package_name, instance_name)
+            if instanced:
+                instanced = instanced[2]
+                inputs[instance_name] = [instanced['initial frame data']['data'], instanced['frame data']['data'],
+                                         instanced['canvas size']]
+        return Manifest.key(inputs)
+
+    def update(self):
+        # Bring the outputs up to date with the unit files, returns (frames rendered, frames up to date)
+        stamps = self._stamps()
+        changed_files = {name for name in set(stamps) | set(self.stamps) if stamps.get(name) != self.stamps.get(name)}
+        ssbp_name = f'{self.unit}.ssbp'
+        ssbp_changed = self.ssbp is None or ssbp_name in changed_files
+        textures_changed = bool(changed_files - {ssbp_name})
+
+        if ssbp_changed:
+            with open(os.path.join(self.unit_path, ssbp_name), 'rb') as file:
+                self.ssbp = SSBP(file)
+        update_cellmap(self.unit, self.ssbp, self.manifest, data_path=self.data_path,
+                       output_path=self.output_path, profile=self.texture_profile, index=self.index, store=self.store,
+                       texture_cache=self.texture_cache)
+        textures = texture_inputs(self.manifest, self.ssbp, self.data_path, self.unit)
+
+        previous = self.decoder
+        # A store split gives changed textures new hashes, so the decoder has to load the new mapping
+        if ssbp_changed or (textures_changed and self.store):
+            self.decoder = SSFrameDecoder(self.ssbp, export_path=self.unit_output_path,
+                                          texture_profile=self.texture_profile, texture_cache=self.texture_cache)
+            # Keep the sprites that are still valid, atlases only change with the textures,
+            # reduced cells also change when their rectangle does
+            if previous and not textures_changed:
+                self.decoder.atlases.update(previous.atlases)
+                rects = {cell['name']: (cell['pos'], cell['size']) for cell in self.decoder.cells}
+                previous_rects = {cell['name']: (cell['pos'], cell['size']) for cell in previous.cells}
+                self.decoder.mip_sprites.update({key: sprite for key, sprite in previous.mip_sprites.items()
+                                                 if rects.get(key[0]) == previous_rects.get(key[0])})
+        elif textures_changed:
+            self.decoder.clear_sprites()
+
+        rendered = skipped = 0
+        for package_name, package in self.decoder.animation_packages.items():
+            if self.packages and not any(fnmatch.fnmatchcase(package_name, p) for p in self.packages):
+                continue
+            for animation_name, animation in package['animations'].items():
+                if self.animations and not any(fnmatch.fnmatchcase(animation_name, p) for p in self.animations):
+                    continue
+                key = self._animation_key(package_name, animation_name, textures)
+                if self.animation_keys.get((package_name, animation_name)) == key:
+                    skipped += animation['frame count']
+                    continue
+                for time in range(animation['frame count']):
+                    artifact = output_path(f'{package_name}-{animation_name}-{time}', self.profile)
+                    inputs = render_inputs(self.decoder, package_name, animation_name, time, textures, self.profile,
+                                           canvas=self.canvas, quality=self.quality)
+                    if self.manifest.is_up_to_date(artifact, inputs):
+                        skipped += 1
+                        continue
+                    image = self.decoder.render_frame(package_name, animation_name, time, debug=False,
+                                                      canvas=self.canvas, quality=self.quality)
+                    save_image(image, os.path.join(self.unit_output_path, artifact), self.profile)
+                    self.manifest.record(artifact, inputs)
+                    rendered += 1
+                self.animation_keys[(package_name, animation_name)] = key
+
+        self.manifest.save()
+        self.stamps = stamps
+        return rendered, skipped
+
+
+def watch(units, data_path='data/Unit', interval=0.5, callback=print, debug=False, **kwargs):
+    # Poll the unit folders matching the names or globs and update the units that changed, units added
+    # while watching are picked up too. Runs until interrupted
+    watchers = {}
+    while True:
+        available = sorted(name for name in os.listdir(data_path)
+                           if os.path.isfile(os.path.join(data_path, name, f'{name}.ssbp')))
+        for unit in available:
+            if unit not in watchers and any(fnmatch.fnmatchcase(unit, pattern) for pattern in units):
+                watchers[unit] = UnitWatcher(unit, data_path=data_path, **kwargs)
+        for unit, watcher in watchers.items():
+            try:
+                if not watcher.changed():
+                    continue
+                started = clock.perf_counter()
+                rendered, skipped = watcher.update()
+                callback(f'{unit}: rendered {rendered} frames, {skipped} up to date '
+                         f'in {clock.perf_counter() - started:.2f}s')
+            except Exception as error:
+                # Files are often caught half written, the next save triggers another update
+                callback(f'! {unit}: {type(error).__name__}: {error}')
+                if debug:
+                    callback(traceback.format_exc())
+                # Start over from the files as they are now
+                watcher.stamps, watcher.ssbp, watcher.decoder = watcher._stamps(), None, None
+        clock.sleep(interval)
+
+
+if __name__ == "__main__":
+    try:
+        watch(['ch04_12_Tiki_F_Normal'])
+    except KeyboardInterrupt:
+        pass